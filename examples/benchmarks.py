@@ -0,0 +1,316 @@
+"""Benchmark suite, against a stub server in a child process
+
+Cases:
+* encode: `Notification.encode`
+* encode-generic: `Notification.get_dict` and `json.dumps`, to compare
+* request: `Request.new`
+* connection: `Connection.post` on one connection
+* pool-1, pool-2, pool-4: `Pool.post` with that many connections
+* saturation: a burst several times over the server's stream limit
+* memory: bytes allocated per request in flight on a connection
+* fault-<scenario>, fault-<scenario>-apns: the `aapns.faults` scenarios, with
+  a `Pool` or an `APNS` client, reporting goodput, error amplification, time
+  to recover and peak `pending` and `retrying`; these run the stub in process
+
+Reports notifications per second, latency percentiles and the CPU time per
+notification of this process, the stub's CPU time isn't included. Results
+can be saved as JSON, to compare across releases.
+
+Run:
+    python examples/benchmarks.py [--count=5000] [--json=results.json] [case ...]
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import platform
+import sys
+import tracemalloc
+from asyncio import gather, sleep
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter, process_time
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Tuple
+
+from aapns.connection import Connection, Request, cached_ssl_context
+from aapns.errors import APNSError
+from aapns.faults import SCENARIOS, run
+from aapns.models import Alert, Notification
+from aapns.pool import Pool
+from aapns.stub import StubServer
+
+SERVER_CERT = "tests/functional/test-server-certificate.pem"
+SERVER_KEY = "tests/functional/test-server-private-key.pem"
+CLIENT_CERT = "tests/functional/test-client-certificate.pem"
+
+
+@dataclass
+class Result:
+    case: str
+    count: int
+    seconds: float
+    cpu: float
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    def summary(self) -> Dict[str, Any]:
+        summary = dict(
+            case=self.case,
+            count=self.count,
+            per_second=round(self.count / self.seconds),
+            cpu_us=round(self.cpu / self.count * 1e6, 1),
+            errors=self.errors,
+        )
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+                value = latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+                summary[f"{name}_ms"] = round(value * 1000, 2)
+        summary.update(self.extra)
+        return summary
+
+
+def serve(options: Dict[str, Any], ports: multiprocessing.Queue):
+    latency = options.pop("latency", 0.0)
+
+    async def main():
+        async with StubServer(
+            SERVER_CERT, SERVER_KEY, latency=lambda rng: latency, seed=1, **options
+        ) as stub:
+            ports.put(stub.port)
+            await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+@contextmanager
+def stub_process(**options: Any) -> Iterator[str]:
+    """Origin of a stub server running in a child process"""
+    ports: multiprocessing.Queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(options, ports), daemon=True)
+    process.start()
+    try:
+        yield f"https://localhost:{ports.get(timeout=10)}"
+    finally:
+        process.terminate()
+        process.join()
+
+
+def requests(count: int, timeout: float = 10) -> List[Request]:
+    return [
+        Request.new(
+            f"/3/device/{i:064x}",
+            {"apns-topic": "com.example.app", "apns-push-type": "alert"},
+            {"aps": {"alert": {"body": "hello"}}},
+            timeout=timeout,
+        )
+        for i in range(count)
+    ]
+
+
+async def drive(
+    post: Callable[[Request], Awaitable[Any]],
+    batch: List[Request],
+    concurrency: int,
+    result: Result,
+):
+    """Post the requests with at most `concurrency` in flight"""
+    pending = iter(batch)
+
+    async def worker():
+        for request in pending:
+            start = perf_counter()
+            try:
+                await post(request)
+                result.latencies.append(perf_counter() - start)
+            except APNSError:
+                result.errors += 1
+
+    await gather(*(worker() for i in range(concurrency)))
+
+
+@contextmanager
+def measure(case: str, count: int) -> Iterator[Result]:
+    result = Result(case, count, 0, 0)
+    wall, cpu = perf_counter(), process_time()
+    yield result
+    result.seconds, result.cpu = perf_counter() - wall, process_time() - cpu
+
+
+NOTIFICATION = Notification(
+    alert=Alert(title="Hello", body="Something happened"),
+    badge=3,
+    sound="default",
+    extra={"article": 42},
+)
+
+
+async def encode(count: int) -> Result:
+    with measure("encode", count) as result:
+        for i in range(count):
+            NOTIFICATION.encode(sort_keys=False)
+    return result
+
+
+async def encode_generic(count: int) -> Result:
+    with measure("encode-generic", count) as result:
+        for i in range(count):
+            json.dumps(
+                NOTIFICATION.get_dict(), ensure_ascii=False, separators=(",", ":")
+            ).encode()
+    return result
+
+
+async def request(count: int) -> Result:
+    header = {"apns-topic": "com.example.app", "apns-push-type": "alert"}
+    data = {"aps": {"alert": {"body": "hello"}}}
+    with measure("request", count) as result:
+        for i in range(count):
+            Request.new(f"/3/device/{i:064x}", header, data)
+    return result
+
+
+async def connection(count: int) -> Result:
+    with stub_process(latency=0.005) as origin:
+        conn = await Connection.create(
+            origin, cached_ssl_context(CLIENT_CERT, SERVER_CERT)
+        )
+        try:
+            batch = requests(count)
+            with measure("connection", count) as result:
+                await drive(conn.post, batch, 100, result)
+        finally:
+            await conn.close()
+    return result
+
+
+def pool(size: int) -> Callable[[int], Awaitable[Result]]:
+    async def case(count: int) -> Result:
+        with stub_process(latency=0.005) as origin:
+            ssl = cached_ssl_context(CLIENT_CERT, SERVER_CERT)
+            pool = await Pool.create(origin, size, ssl)
+            try:
+                await sleep(0.1)  # let the connections come up
+                batch = requests(count)
+                with measure(f"pool-{size}", count) as result:
+                    await drive(pool.post, batch, 100 * size, result)
+            finally:
+                await pool.close()
+        return result
+
+    return case
+
+
+async def saturation(count: int) -> Result:
+    """Burst of `count` requests at a server taking 50 at a time, 10ms each"""
+    with stub_process(latency=0.01, max_concurrent_streams=50) as origin:
+        pool = await Pool.create(
+            origin, 1, cached_ssl_context(CLIENT_CERT, SERVER_CERT)
+        )
+        try:
+            await sleep(0.1)
+            batch = requests(count, timeout=2)
+            with measure("saturation", count) as result:
+                await drive(pool.post, batch, count, result)
+            result.extra["goodput"] = round(len(result.latencies) / result.seconds)
+        finally:
+            await pool.close()
+    return result
+
+
+async def memory(count: int) -> Result:
+    """Allocations for requests in flight, including the `post` tasks"""
+    count = min(count, 900)  # within the stub's stream limit
+    with stub_process(latency=1.0) as origin:
+        conn = await Connection.create(
+            origin, cached_ssl_context(CLIENT_CERT, SERVER_CERT)
+        )
+        try:
+            await sleep(0.1)
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                with measure("memory", count) as result:
+                    tasks = [
+                        asyncio.create_task(conn.post(request))
+                        for request in requests(count)
+                    ]
+                    await sleep(0.5)
+                    in_flight = conn.pending
+                    used = tracemalloc.get_traced_memory()[0] - before
+                result.extra["bytes_per_request"] = round(used / in_flight)
+            finally:
+                tracemalloc.stop()
+            await gather(*tasks, return_exceptions=True)
+        finally:
+            await conn.close()
+    return result
+
+
+def fault(name: str, client: str) -> Callable[[int], Awaitable[Result]]:
+    async def case(count: int) -> Result:
+        case = f"fault-{name}" if client == "pool" else f"fault-{name}-{client}"
+        with measure(case, 0) as result:
+            report = await run(
+                SCENARIOS[name], SERVER_CERT, SERVER_KEY, CLIENT_CERT, client=client
+            )
+        result.count = report.sent
+        summary = report.summary()
+        del summary["scenario"], summary["sent"]
+        result.extra.update(summary)
+        return result
+
+    return case
+
+
+CASES: Dict[str, Callable[[int], Awaitable[Result]]] = {
+    "encode": encode,
+    "encode-generic": encode_generic,
+    "request": request,
+    "connection": connection,
+    "pool-1": pool(1),
+    "pool-2": pool(2),
+    "pool-4": pool(4),
+    "saturation": saturation,
+    "memory": memory,
+    **{f"fault-{name}": fault(name, "pool") for name in SCENARIOS},
+    **{f"fault-{name}-apns": fault(name, "apns") for name in SCENARIOS},
+}
+
+
+async def main(names: List[str], count: int) -> List[Dict[str, Any]]:
+    summaries = []
+    for name in names:
+        # the pure CPU cases are quick, give them more to chew on
+        result = await CASES[name](
+            count * 20 if name in ("encode", "encode-generic", "request") else count
+        )
+        summaries.append(result.summary())
+        logging.info("%s", json.dumps(summaries[-1]))
+    return summaries
+
+
+def parse(args: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    options = dict(
+        (arg[2:].split("=", 1) + [""])[:2] for arg in args if arg[:2] == "--"
+    )
+    names = [arg for arg in args if arg[:2] != "--"] or list(CASES)
+    return names, options
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    names, options = parse(sys.argv[1:])
+    summaries = asyncio.run(main(names, int(options.get("count", 5000))))
+    if "json" in options:
+        with open(options["json"], "w") as f:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    machine=platform.machine(),
+                    results=summaries,
+                ),
+                f,
+                indent=2,
+            )
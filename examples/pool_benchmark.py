@@ -2,8 +2,9 @@
 
 Performance test for the connection pool.
 
-Expects a local server on port 2197, for example, run:
-    go run tests/stress/server-ok.go
+Runs against an in-process stub server, or with --external, expects a local
+server on port 2197, for example, run:
+    go run tests/functional/server-ok.go
 
 Be careful if you target sandbox or production server, Apple won't like the flood.
 Consider limiting number of requests to ~100 or so.
@@ -16,6 +17,7 @@ from contextlib import suppress
 from typing import Any, Dict
 
 from aapns.pool import Blocked, Closed, Pool, Request, Timeout, create_ssl_context
+from aapns.stub import StubServer
 
 
 async def one_request(c, i):
@@ -31,7 +33,17 @@ async def one_request(c, i):
         pass
 
 
-async def many_requests(count):
+async def with_stub(count):
+    async with StubServer(
+        "tests/functional/test-server-certificate.pem",
+        "tests/functional/test-server-private-key.pem",
+        latency=lambda rng: rng.expovariate(1 / 0.05),
+    ) as stub:
+        await many_requests(count, stub.origin)
+        logging.info("Stub responses %s", dict(stub.responses))
+
+
+async def many_requests(count, origin="https://localhost:2197"):
     c = None
 
     async def monitor():
@@ -55,7 +67,7 @@ async def many_requests(count):
     )
 
     try:
-        c = await Pool.create("https://localhost:2197", ssl=ssl_context)
+        c = await Pool.create(origin, ssl=ssl_context)
         try:
             await sleep(0.1)
             await gather(*[one_request(c, i) for i in range(count)])
@@ -71,5 +83,6 @@ async def many_requests(count):
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
-    run(many_requests(count))
+    args = [arg for arg in sys.argv[1:] if arg != "--external"]
+    count = int(args[0]) if args else 2000
+    run(many_requests(count) if "--external" in sys.argv else with_stub(count))
@@ -0,0 +1,43 @@
+"""Per-token CPU cost of building requests for a broadcast
+
+Compares a fresh `Request` per token, as `APNS.send_notification` builds it,
+with requests built from a `PreparedNotification` that is encoded once.
+
+Run:
+    python examples/prepared_benchmark.py [count]
+"""
+import sys
+from timeit import timeit
+
+from aapns.api import PreparedNotification
+from aapns.config import Priority
+from aapns.models import Alert, Notification
+
+
+def main(count):
+    notification = Notification(
+        alert=Alert(title="Breaking news", body="Something happened " * 10),
+        badge=1,
+        sound="default",
+        extra={"article": {"id": 1234, "section": "world"}},
+    )
+    options = dict(priority=Priority.immediately, topic="com.example.app")
+    tokens = [f"{i:064x}" for i in range(count)]
+
+    def fresh():
+        for token in tokens:
+            PreparedNotification.new(notification, **options).request(token)
+
+    prepared = PreparedNotification.new(notification, **options)
+
+    def once():
+        for token in tokens:
+            prepared.request(token)
+
+    for name, fn in (("per token", fresh), ("prepared", once)):
+        took = timeit(fn, number=1)
+        print(f"{name:>10}: {took / count * 1e6:6.2f}µs per token")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
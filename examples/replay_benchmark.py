@@ -0,0 +1,77 @@
+"""Profile response processing in aapns.connection.Connection, without I/O
+
+Records requests to an in-memory stub server, or loads a recording saved
+earlier, then replays it several times and reports the time per request.
+
+    python examples/replay_benchmark.py [count] [--save=file] [--load=file] [--profile]
+"""
+import cProfile
+import logging
+import pstats
+import sys
+from asyncio import gather, run
+from time import perf_counter
+
+from aapns.connection import Connection, Request
+from aapns.loopback import Recording, replay
+from aapns.stub import StubServer
+
+
+async def record(count):
+    recording = Recording()
+    async with StubServer(reasons={"BadDeviceToken": 0.01}, seed=1) as stub:
+        connection = Connection.over(*stub.pipe(), recording=recording)
+        try:
+            # in batches, as many as the server allows at first
+            for batch in range(0, count, 100):
+                await gather(
+                    *(
+                        connection.post(
+                            Request.new(
+                                f"/3/device/{i:064x}",
+                                {
+                                    "apns-topic": "com.example.app",
+                                    "apns-push-type": "alert",
+                                },
+                                {"aps": {"alert": {"body": "hello"}}},
+                            )
+                        )
+                        for i in range(batch, min(batch + 100, count))
+                    )
+                )
+        finally:
+            await connection.close()
+    return recording
+
+
+async def main(count, options):
+    if "load" in options:
+        recording = Recording.load(options["load"])
+    else:
+        recording = await record(count)
+    if "save" in options:
+        recording.save(options["save"])
+    requests = len(recording.requests())
+
+    best = float("inf")
+    for i in range(5):
+        start = perf_counter()
+        await replay(recording)
+        best = min(best, perf_counter() - start)
+    logging.info("%d requests, %.1fµs per request", requests, best / requests * 1e6)
+
+    if "profile" in options:
+        profile = cProfile.Profile()
+        profile.enable()
+        await replay(recording)
+        profile.disable()
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    options = dict(
+        (arg[2:].split("=", 1) + [""])[:2] for arg in sys.argv[1:] if arg[:2] == "--"
+    )
+    args = [arg for arg in sys.argv[1:] if arg[:2] != "--"]
+    run(main(int(args[0]) if args else 10_000, options))
@@ -0,0 +1,62 @@
+"""Scale the number of worker processes of aapns.sharded.ShardedSender
+
+Runs against the `aapns.stub` server in a child process. That stub is Python
+on one core, so it saturates at a couple of workers: the figures then show
+the stub's limit rather than how the sender scales. To measure that, use
+--external, which expects a local server on port 2197, for example, run:
+    go run tests/functional/server-ok.go
+
+Be careful if you target sandbox or production server, Apple won't like the flood.
+
+Run:
+    python examples/sharded_benchmark.py [--external] [count]
+"""
+import logging
+import os
+import sys
+from contextlib import nullcontext
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from aapns.api import PreparedNotification, Server
+from aapns.models import Alert, Notification
+from aapns.sharded import ShardedSender
+
+from benchmarks import stub_process
+
+CLIENT_CERT = "tests/functional/test-client-certificate.pem"
+SERVER_CERT = "tests/functional/test-server-certificate.pem"
+
+
+def main(count, port):
+    target = Server(
+        client_cert_path=CLIENT_CERT, host="localhost", port=port, ca_file=SERVER_CERT
+    )
+    prepared = PreparedNotification.new(Notification(alert=Alert(body="hello")))
+    tokens = [f"{i:064x}" for i in range(count)]
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        with ShardedSender.create(target, workers) as sender:
+            start = perf_counter()
+            for token, outcome in sender.post_many(tokens, prepared):
+                pass
+            elapsed = perf_counter() - start
+            logging.info(
+                "%d workers: %.0f notifications/s %s",
+                workers,
+                count / elapsed,
+                dict(sender.stats),
+            )
+        workers *= 2
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    external = "--external" in args
+    args = [a for a in args if a != "--external"]
+    count = int(args[0]) if args else 100_000
+    with nullcontext(
+        "https://localhost:2197"
+    ) if external else stub_process() as origin:
+        main(count, urlsplit(origin).port)
@@ -0,0 +1,89 @@
+"""Compare task per notification `APNS.send_prepared` against callback based
+`APNS.submit`
+
+Runs against an in-process stub server, which shares the CPU, so compare the
+figures rather than read them as absolute. Or with --external, expects a local
+server on port 2197, for example, run:
+    go run tests/functional/server-ok.go
+
+Be careful if you target sandbox or production server, Apple won't like the flood.
+"""
+import asyncio
+import logging
+import sys
+from asyncio import gather, get_running_loop, run, sleep
+from time import perf_counter
+
+from aapns.api import PreparedNotification, Server
+from aapns.errors import APNSError, Blocked
+from aapns.models import Alert, Notification
+from aapns.stub import StubServer
+
+CLIENT_CERT = "tests/functional/test-client-certificate.pem"
+SERVER_CERT = "tests/functional/test-server-certificate.pem"
+SERVER_KEY = "tests/functional/test-server-private-key.pem"
+
+
+async def send_all(client, prepared, tokens):
+    async def one(token):
+        try:
+            await client.send_prepared(token, prepared)
+        except APNSError:
+            pass
+
+    await gather(*(one(token) for token in tokens))
+
+
+async def submit_all(client, prepared, tokens):
+    done = get_running_loop().create_future()
+    room = asyncio.Event()
+    remaining = len(tokens)
+
+    def callback(token, outcome):
+        nonlocal remaining
+        remaining -= 1
+        room.set()
+        if not remaining:
+            done.set_result(None)
+
+    for token in tokens:
+        while True:
+            try:
+                client.submit(token, prepared, callback)
+                break
+            except Blocked:
+                # the pool's backlog is full, wait for some to complete
+                room.clear()
+                await room.wait()
+    await done
+
+
+async def main(count, port):
+    client = await Server(
+        CLIENT_CERT, "localhost", port, ca_file=SERVER_CERT
+    ).create_client()
+    prepared = PreparedNotification.new(Notification(alert=Alert(body="hello")))
+    tokens = [f"{i:064x}" for i in range(count)]
+    try:
+        await sleep(0.1)
+        for method in (send_all, submit_all) * 2:
+            start = perf_counter()
+            await method(client, prepared, tokens)
+            elapsed = perf_counter() - start
+            logging.info(
+                "%s: %.1fµs per notification", method.__name__, elapsed / count * 1e6
+            )
+    finally:
+        await client.close()
+
+
+async def with_stub(count):
+    async with StubServer(SERVER_CERT, SERVER_KEY) as stub:
+        await main(count, stub.port)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = [arg for arg in sys.argv[1:] if arg != "--external"]
+    count = int(args[0]) if args else 10000
+    run(main(count, 2197) if "--external" in sys.argv else with_stub(count))
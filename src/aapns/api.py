@@ -2,18 +2,46 @@ from __future__ import annotations
 
 import abc
 import asyncio
+import re
+import ssl
 from dataclasses import dataclass, replace
+from functools import lru_cache, partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Optional
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterable,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from . import config, errors, models
+from .coalesce import Coalescer
+from .codec import Codec
 from .config import (
+    DEVICE_TOKEN_MAX_LENGTH,
+    DEVICE_TOKEN_MIN_LENGTH,
     MAX_NOTIFICATION_PAYLOAD_SIZE_OTHER,
     MAX_NOTIFICATION_PAYLOAD_SIZE_VOIP,
 )
+from .connection import cached_ssl_context
 from .models import PushType
-from .pool import Pool, PoolProtocol, Request, create_ssl_context
+from .pool import Pool, PoolProtocol, Request, Response
+from .suppression import SuppressionStore
+
+T = TypeVar("T")
+# whole bytes, within the length bounds
+DEVICE_TOKEN_RE = re.compile(
+    "(?:[0-9a-f]{2}){%d,%d}"
+    % (DEVICE_TOKEN_MIN_LENGTH // 2, DEVICE_TOKEN_MAX_LENGTH // 2)
+)
 
 
 class APNSBaseClient(metaclass=abc.ABCMeta):
@@ -26,7 +54,7 @@ class APNSBaseClient(metaclass=abc.ABCMeta):
     async def send_notification(
         self,
         token: str,
-        notification: models.Notification,
+        notification: models.AnyNotification,
         *,
         apns_id: Optional[str] = None,
         expiration: Optional[int] = None,
@@ -40,6 +68,38 @@ class APNSBaseClient(metaclass=abc.ABCMeta):
         """
         pass
 
+    async def send_many(
+        self,
+        tokens: Union[Iterable[str], AsyncIterable[str]],
+        notification: models.AnyNotification,
+        *,
+        concurrency: int = 1000,
+        expiration: Optional[int] = None,
+        priority: config.Priority = config.Priority.normal,
+        topic: Optional[str] = None,
+        collapse_id: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[str, Union[Optional[str], errors.APNSError]]]:
+        """
+        Send the same notification to every device in `tokens`, which may be
+        an iterable or an async iterable.
+
+        At most `concurrency` notifications are in progress at any time and
+        tokens are consumed lazily, so memory use does not depend on the number
+        of tokens. Yields `(token, outcome)` pairs in completion order, where
+        `outcome` is the APNS ID on success or the `APNSError` that sending
+        to this token failed with. Other exceptions are raised.
+        """
+        send = partial(
+            self.send_notification,
+            notification=notification,
+            expiration=expiration,
+            priority=priority,
+            topic=topic,
+            collapse_id=collapse_id,
+        )
+        async for item in send_each(tokens, send, concurrency):
+            yield item
+
     async def close(self):
         """
         Close the client. This coroutine should only be called once and
@@ -48,6 +108,66 @@ class APNSBaseClient(metaclass=abc.ABCMeta):
         pass
 
 
+async def send_each(
+    tokens: Union[Iterable[str], AsyncIterable[str]],
+    send: Callable[[str], Awaitable[T]],
+    concurrency: int,
+) -> AsyncIterator[Tuple[str, Union[T, errors.APNSError]]]:
+    """
+    Call `send` for every token with at most `concurrency` calls in progress,
+    yielding `(token, outcome)` pairs in completion order. See `send_many`.
+    """
+    if concurrency < 1:
+        raise ValueError("Concurrency must be strictly positive")
+
+    todo: asyncio.Queue = asyncio.Queue(concurrency)
+    done: asyncio.Queue = asyncio.Queue(concurrency)
+
+    async def feed():
+        try:
+            if isinstance(tokens, AsyncIterable):
+                async for token in tokens:
+                    await todo.put(token)
+            else:
+                for token in tokens:
+                    await todo.put(token)
+        except Exception as e:
+            await done.put(e)
+        for i in range(concurrency):
+            await todo.put(None)
+
+    async def work():
+        try:
+            while (token := await todo.get()) is not None:
+                outcome: Union[T, errors.APNSError]
+                try:
+                    outcome = await send(token)
+                except errors.APNSError as e:
+                    outcome = e
+                await done.put((token, outcome))
+        except Exception as e:
+            await done.put(e)
+        await done.put(None)
+
+    tasks = [asyncio.create_task(feed(), name="send-many-feed")] + [
+        asyncio.create_task(work(), name="send-many-work") for i in range(concurrency)
+    ]
+    try:
+        working = concurrency
+        while working:
+            item = await done.get()
+            if item is None:
+                working -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 class Target(metaclass=abc.ABCMeta):
     """
     Abstract base class defining the API a Target must implement.
@@ -77,14 +197,23 @@ class Server(Target):
     pool_size: int = 2
 
     async def create_client(self) -> APNSBaseClient:
-        base_url = f"https://{self.host}:{self.port}"
-        ssl_context = create_ssl_context()
-        if self.ca_file:
-            ssl_context.load_verify_locations(cafile=self.ca_file)
-        ssl_context.load_cert_chain(
-            certfile=self.client_cert_path, keyfile=self.client_cert_path
+        return APNS(
+            await Pool.create(
+                self.origin, size=self.pool_size, ssl=self.create_ssl_context()
+            )
         )
-        return APNS(await Pool.create(base_url, size=self.pool_size, ssl=ssl_context))
+
+    @property
+    def origin(self) -> str:
+        return f"https://{self.host}:{self.port}"
+
+    def create_ssl_context(self) -> ssl.SSLContext:
+        """SSL context with the client certificate and optional CA file
+
+        Shared with other servers using the same files, until they change, so
+        it must not be modified.
+        """
+        return cached_ssl_context(self.client_cert_path, self.ca_file)
 
     @classmethod
     def production(cls, client_cert_path: str) -> Server:
@@ -133,7 +262,7 @@ class Simulator(Target, APNSBaseClient):
     async def send_notification(
         self,
         token: str,
-        notification: models.Notification,
+        notification: models.AnyNotification,
         *,
         apns_id: Optional[str] = None,
         expiration: Optional[int] = None,
@@ -154,54 +283,409 @@ class Simulator(Target, APNSBaseClient):
         return None
 
 
+class Result(NamedTuple):
+    """
+    Compact record of the server response to a notification.
+
+    Returned instead of raising by the `post_*` methods of `APNS`.
+    """
+
+    status: int
+    reason: Optional[str]
+    apns_id: Optional[str]
+    timestamp: Optional[int]
+
+    @classmethod
+    def from_response(cls, response: Response) -> Result:
+        return cls(response.code, response.reason, response.apns_id, response.timestamp)
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200
+
+    def error(self) -> errors.ResponseError:
+        """The exception `send_notification` would have raised for this result"""
+        return errors.get(self.reason, self.apns_id)
+
+
+# Result for tokens rejected by the suppression store, without a request
+SUPPRESSED = Result(0, "Suppressed", None, None)
+# Result for tokens rejected by local validation, without a request
+MALFORMED = Result(0, "BadDeviceToken", None, None)
+
+
+def device_token(token: str) -> Optional[str]:
+    """
+    Device token normalised to lower case without surrounding whitespace, or
+    None if it isn't an even count of hex digits within the length bounds.
+    """
+    if DEVICE_TOKEN_RE.fullmatch(token):
+        return token
+    return normalised_device_token(token)
+
+
+@lru_cache(maxsize=2 ** 16)
+def normalised_device_token(token: str) -> Optional[str]:
+    token = token.strip().lower()
+    return token if DEVICE_TOKEN_RE.fullmatch(token) else None
+
+
+def device_path(token: str) -> Optional[str]:
+    """Request path for the normalised device token, see `device_token`"""
+    normalised = device_token(token)
+    return None if normalised is None else f"/3/device/{normalised}"
+
+
+@dataclass(frozen=True)
+class PreparedNotification:
+    """
+    A notification validated, encoded and size checked once, for sending the
+    same payload to many devices. Only the device path and the APNS ID vary
+    between the requests built from it.
+    """
+
+    header: tuple
+    body: bytes
+    collapse_id: Optional[str] = None
+    expiration: Optional[int] = None
+
+    @classmethod
+    def new(
+        cls,
+        notification: models.AnyNotification,
+        *,
+        expiration: Optional[int] = None,
+        priority: config.Priority = config.Priority.normal,
+        topic: Optional[str] = None,
+        collapse_id: Optional[str] = None,
+        codec: Optional[Codec] = None,
+        fit: bool = False,
+    ) -> PreparedNotification:
+        """
+        If `fit` is set, an alert body or title too long for the payload size
+        limit is shortened to fit, see `models.fit`. Otherwise, and if it still
+        doesn't fit, `ValueError` is raised.
+        """
+        voip = notification.push_type is PushType.voip
+        limit = (
+            MAX_NOTIFICATION_PAYLOAD_SIZE_VOIP
+            if voip
+            else MAX_NOTIFICATION_PAYLOAD_SIZE_OTHER
+        )
+        body = notification.encode(sort_keys=False, codec=codec)
+        if fit and len(body) > limit:
+            notification = models.fit(notification, limit, codec=codec)
+            body = notification.encode(sort_keys=False, codec=codec)
+        if len(body) > limit:
+            raise ValueError(
+                f"Notification payload exceeds maximum payload size for "
+                f"{'voip' if voip else 'non-voip'} notifications of {limit} bytes, "
+                f"it is {len(body)} bytes"
+            )
+        header = (
+            ("apns-priority", str(priority.value)),
+            ("apns-push-type", notification.push_type.value),
+            *((("apns-expiration", str(expiration)),) if expiration else ()),
+            *((("apns-topic", topic),) if topic else ()),
+            *((("apns-collapse-id", collapse_id),) if collapse_id else ()),
+        )
+        return cls(header, body, collapse_id, expiration)
+
+    def request(
+        self,
+        token: str,
+        *,
+        apns_id: Optional[str] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> Request:
+        return self.request_to(
+            f"/3/device/{token}", apns_id=apns_id, timeout=timeout, deadline=deadline
+        )
+
+    def request_to(
+        self,
+        path: str,
+        *,
+        apns_id: Optional[str] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> Request:
+        """
+        Request to post the notification to `path`, which must be sent
+        before the `timeout`, `deadline` and notification expiration.
+        """
+        header = self.header + ((("apns-id", apns_id),) if apns_id else ())
+        # Expiration 0 means "now or never" rather than a deadline
+        expiration = self.expiration or None
+        return Request.encoded(path, header, self.body, timeout, deadline, expiration)
+
+
 @dataclass(frozen=True)
 class APNS(APNSBaseClient):
+    """
+    Client for APNS servers, usually created with `Server.create_client`.
+
+    If a `suppression` store is given, tokens the server has responded to with
+    `Unregistered` or `BadDeviceToken` are added to it, and later notifications
+    to these tokens fail with `Suppressed` without a request to the server.
+
+    If `validate_tokens` is set, tokens are normalised and malformed tokens
+    fail with `BadDeviceToken` without a request to the server.
+
+    If a `coalescer` is given, a notification with a collapse ID or a
+    `coalesce_key` is not sent while an earlier one for the same device and
+    collapse ID (or with the same key) is pending, but gets its result.
+
+    Notifications that can't be sent within `timeout` seconds, by the UNIX time
+    `deadline` or by their nonzero `expiration` fail with `Timeout`.
+
+    If `fit_payloads` is set, alert texts too long for the payload size limit
+    are shortened and end with an ellipsis, rather than failing.
+    """
+
     pool: PoolProtocol
+    suppression: Optional[SuppressionStore] = None
+    validate_tokens: bool = False
+    coalescer: Optional[Coalescer] = None
+    codec: Optional[Codec] = None
+    fit_payloads: bool = False
 
     async def send_notification(
         self,
         token: str,
-        notification: models.Notification,
+        notification: models.AnyNotification,
         *,
         apns_id: Optional[str] = None,
         expiration: Optional[int] = None,
         priority: config.Priority = config.Priority.normal,
         topic: Optional[str] = None,
         collapse_id: Optional[str] = None,
+        coalesce_key: Optional[Hashable] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
     ) -> Optional[str]:
 
-        request = Request.new(
-            path=f"/3/device/{token}",
-            header={
-                "apns-priority": str(priority.value),
-                "apns-push-type": notification.push_type.value,
-                **({"apns-id": apns_id} if apns_id else {}),
-                **({"apns-expiration": str(expiration)} if expiration else {}),
-                **({"apns-topic": topic} if topic else {}),
-                **({"apns-collapse-id": collapse_id} if collapse_id else {}),
-            },
-            data=notification.get_dict(),
-            timeout=10,
-        )
-        body_size = len(request.body)
-        if notification.push_type is PushType.voip:
-            if body_size > MAX_NOTIFICATION_PAYLOAD_SIZE_VOIP:
-                raise ValueError(
-                    f"Notification payload exceeds maximum payload size for voip "
-                    f"notifications of {MAX_NOTIFICATION_PAYLOAD_SIZE_VOIP} bytes, "
-                    f"it is {body_size} bytes"
+        prepared = PreparedNotification.new(
+            notification,
+            expiration=expiration,
+            priority=priority,
+            topic=topic,
+            collapse_id=collapse_id,
+            codec=self.codec,
+            fit=self.fit_payloads,
+        )
+        return await self.send_prepared(
+            token,
+            prepared,
+            apns_id=apns_id,
+            coalesce_key=coalesce_key,
+            timeout=timeout,
+            deadline=deadline,
+        )
+
+    async def send_prepared(
+        self,
+        token: str,
+        prepared: PreparedNotification,
+        *,
+        apns_id: Optional[str] = None,
+        coalesce_key: Optional[Hashable] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> Optional[str]:
+        """
+        Send a notification prepared with `PreparedNotification.new` to the
+        device identified by the token.
+        """
+        result = await self.post_prepared(
+            token,
+            prepared,
+            apns_id=apns_id,
+            coalesce_key=coalesce_key,
+            timeout=timeout,
+            deadline=deadline,
+        )
+        if not result.ok:
+            raise result.error()
+        return result.apns_id
+
+    async def post_notification(
+        self,
+        token: str,
+        notification: models.AnyNotification,
+        *,
+        apns_id: Optional[str] = None,
+        expiration: Optional[int] = None,
+        priority: config.Priority = config.Priority.normal,
+        topic: Optional[str] = None,
+        collapse_id: Optional[str] = None,
+        coalesce_key: Optional[Hashable] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> Result:
+        """
+        Like `send_notification`, but returns a `Result` rather than raising
+        when the server rejects the notification. Errors that prevent getting
+        a response from the server, such as `Timeout` or `Closed`, are raised.
+        """
+        prepared = PreparedNotification.new(
+            notification,
+            expiration=expiration,
+            priority=priority,
+            topic=topic,
+            collapse_id=collapse_id,
+            codec=self.codec,
+            fit=self.fit_payloads,
+        )
+        return await self.post_prepared(
+            token,
+            prepared,
+            apns_id=apns_id,
+            coalesce_key=coalesce_key,
+            timeout=timeout,
+            deadline=deadline,
+        )
+
+    async def post_prepared(
+        self,
+        token: str,
+        prepared: PreparedNotification,
+        *,
+        apns_id: Optional[str] = None,
+        coalesce_key: Optional[Hashable] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> Result:
+        """Like `send_prepared`, but returns a `Result` rather than raising."""
+        if self.validate_tokens:
+            if (normalised := device_token(token)) is None:
+                return MALFORMED
+            token = normalised
+        if self.suppression is not None and token in self.suppression:
+            return SUPPRESSED
+        request = prepared.request_to(
+            f"/3/device/{token}", apns_id=apns_id, timeout=timeout, deadline=deadline
+        )
+        if coalesce_key is None and prepared.collapse_id:
+            coalesce_key = (token, prepared.collapse_id)
+        if self.coalescer is not None and coalesce_key is not None:
+            response = await self.coalescer.post(coalesce_key, request, self.pool.post)
+        else:
+            response = await self.pool.post(request)
+        return self.record(token, Result.from_response(response))
+
+    def submit(
+        self,
+        token: str,
+        prepared: PreparedNotification,
+        callback: Callable[[str, Union[Result, errors.APNSError]], None],
+        *,
+        apns_id: Optional[str] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ):
+        """Send a prepared notification without waiting for the outcome
+
+        `callback(token, outcome)` is called with the `Result` or the error once
+        the request is done, possibly before this returns. Unlike `post_prepared`,
+        this doesn't need a task per notification, which is cheaper when sending
+        a lot. Requests are not coalesced. The pool must support `submit`, the
+        way `Pool` does; `Pool.submit` raises `Blocked` when its backlog is full.
+        """
+        submit = getattr(self.pool, "submit", None)
+        if submit is None:
+            raise TypeError(f"{type(self.pool).__name__} doesn't support submit")
+        key = token
+        if self.validate_tokens:
+            if (normalised := device_token(token)) is None:
+                return callback(token, MALFORMED)
+            key = normalised
+        if self.suppression is not None and key in self.suppression:
+            return callback(token, SUPPRESSED)
+        request = prepared.request_to(
+            f"/3/device/{key}", apns_id=apns_id, timeout=timeout, deadline=deadline
+        )
+
+        def done(request: Request, outcome: Union[Response, errors.APNSError]):
+            if isinstance(outcome, Response):
+                callback(token, self.record(key, Result.from_response(outcome)))
+            else:
+                callback(token, outcome)
+
+        submit(request, done)
+
+    def record(self, token: str, result: Result) -> Result:
+        """Note tokens reported invalid in the suppression store, if any"""
+        if self.suppression is not None:
+            if result.reason == "Unregistered":
+                self.suppression.add(
+                    token, result.timestamp / 1000 if result.timestamp else None
                 )
-        elif body_size > MAX_NOTIFICATION_PAYLOAD_SIZE_OTHER:
-            raise ValueError(
-                f"Notification payload exceeds maximum payload size for non-voip "
-                f"notifications of {MAX_NOTIFICATION_PAYLOAD_SIZE_OTHER} bytes, "
-                f"it is {body_size} bytes"
-            )
+            elif result.reason == "BadDeviceToken":
+                self.suppression.add(token)
+        return result
 
-        response = await self.pool.post(request)
-        if response.code != 200:
-            raise errors.get(response.reason, response.apns_id)
-        return response.apns_id
+    async def send_many(
+        self,
+        tokens: Union[Iterable[str], AsyncIterable[str]],
+        notification: models.AnyNotification,
+        *,
+        concurrency: int = 1000,
+        expiration: Optional[int] = None,
+        priority: config.Priority = config.Priority.normal,
+        topic: Optional[str] = None,
+        collapse_id: Optional[str] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> AsyncIterator[Tuple[str, Union[Optional[str], errors.APNSError]]]:
+        prepared = PreparedNotification.new(
+            notification,
+            expiration=expiration,
+            priority=priority,
+            topic=topic,
+            collapse_id=collapse_id,
+            codec=self.codec,
+            fit=self.fit_payloads,
+        )
+        send = partial(
+            self.send_prepared, prepared=prepared, timeout=timeout, deadline=deadline
+        )
+        async for item in send_each(tokens, send, concurrency):
+            yield item
+
+    async def post_many(
+        self,
+        tokens: Union[Iterable[str], AsyncIterable[str]],
+        notification: models.AnyNotification,
+        *,
+        concurrency: int = 1000,
+        expiration: Optional[int] = None,
+        priority: config.Priority = config.Priority.normal,
+        topic: Optional[str] = None,
+        collapse_id: Optional[str] = None,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> AsyncIterator[Tuple[str, Union[Result, errors.APNSError]]]:
+        """
+        Like `send_many`, but yields a `Result` for every notification the
+        server responded to. Only errors that prevented getting a response,
+        such as `Timeout`, are yielded as exceptions.
+        """
+        prepared = PreparedNotification.new(
+            notification,
+            expiration=expiration,
+            priority=priority,
+            topic=topic,
+            collapse_id=collapse_id,
+            codec=self.codec,
+            fit=self.fit_payloads,
+        )
+        post = partial(
+            self.post_prepared, prepared=prepared, timeout=timeout, deadline=deadline
+        )
+        async for item in send_each(tokens, post, concurrency):
+            yield item
 
     async def close(self):
         await self.pool.close()
@@ -0,0 +1,53 @@
+"""Coalescing of duplicate notifications that are pending at the same time"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Awaitable, Callable, Dict, Hashable, Tuple
+
+from .connection import Request, Response
+
+
+@dataclass(eq=False)
+class Coalescer:
+    """Posts only one of several requests with the same key at a time
+
+    A request posted while another one with the same key is still pending,
+    that is retrying, buffered or in flight, is not posted. Instead, it gets
+    the response of the pending request.
+
+    If `replace` is set, the newer request replaces the header and body of
+    the pending one, as long as the pending one was not handed to a connection
+    yet. The pending request keeps its deadline, as it may already be queued
+    by that deadline in the pool.
+    """
+
+    replace: bool = False
+    pending: Dict[Hashable, Tuple[Request, asyncio.Task]] = field(default_factory=dict)
+    coalesced: int = 0
+
+    async def post(
+        self,
+        key: Hashable,
+        request: Request,
+        post: Callable[[Request], Awaitable[Response]],
+    ) -> Response:
+        if entry := self.pending.get(key):
+            pending, task = entry
+            self.coalesced += 1
+            if self.replace and not pending.sent:
+                pending.header = request.header
+                pending.body = request.body
+        else:
+            task = asyncio.create_task(post(request))  # type: ignore
+            self.pending[key] = (request, task)
+            task.add_done_callback(partial(self.done, key))
+        # Cancelling one of the callers must not cancel the others
+        return await asyncio.shield(task)
+
+    def done(self, key: Hashable, task: asyncio.Task):
+        if self.pending.get(key, (None, None))[1] is task:
+            del self.pending[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if all callers are gone
@@ -0,0 +1,117 @@
+"""JSON backends for payloads and responses
+
+The stdlib `json` module is always available. `orjson` and `msgspec` are used
+if installed; they are faster, and produce the same compact UTF-8 bytes, but
+for two differences. Floats in exponent notation lose the padding, and with
+`msgspec` the plus sign too: `1e-7` and `1e16` rather than `1e-07` and
+`1e+16`. NaN and infinities become `null`, where stdlib writes `NaN` and
+`Infinity`, which are not valid JSON. Size limits are checked on the bytes
+actually sent, so these differences never let an oversized payload through.
+
+Select a backend per client with `APNS(pool, codec=codec.get("orjson"))` and
+`Pool.create(..., codec=...)`.
+"""
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional, Protocol
+
+
+class Codec(Protocol):
+    @property
+    def name(self) -> str:
+        ...
+
+    def dumps(self, data: Any, sort_keys: bool = False) -> bytes:
+        """Compact UTF-8 JSON, without escaping non-ASCII characters"""
+        ...
+
+    def loads(self, data: bytes) -> Any:
+        ...
+
+    def __hash__(self) -> int:
+        ...
+
+
+@dataclass(frozen=True, eq=False)
+class StdlibCodec:
+    name: str = "json"
+    encoders: Dict[bool, json.JSONEncoder] = field(
+        default_factory=lambda: {
+            sort_keys: json.JSONEncoder(
+                ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys
+            )
+            for sort_keys in (False, True)
+        }
+    )
+
+    def dumps(self, data: Any, sort_keys: bool = False) -> bytes:
+        return self.encoders[sort_keys].encode(data).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+STDLIB = StdlibCodec()
+
+
+@dataclass(frozen=True, eq=False)
+class FastCodec:
+    """Codec using a faster library, with stdlib fallback for what it can't do"""
+
+    name: str
+    encode: Callable[[Any], bytes]
+    encode_sorted: Callable[[Any], bytes]
+    decode: Callable[[bytes], Any]
+
+    def dumps(self, data: Any, sort_keys: bool = False) -> bytes:
+        try:
+            return (self.encode_sorted if sort_keys else self.encode)(data)
+        except TypeError:
+            # e.g. integers over 64 bits, let stdlib encode them or raise
+            return STDLIB.dumps(data, sort_keys)
+
+    def loads(self, data: bytes) -> Any:
+        return self.decode(data)
+
+
+def orjson_codec() -> Optional[FastCodec]:
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    def encode_sorted(data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+
+    return FastCodec("orjson", orjson.dumps, encode_sorted, orjson.loads)
+
+
+def msgspec_codec() -> Optional[FastCodec]:
+    try:
+        import msgspec
+
+        sorted_encoder = msgspec.json.Encoder(order="sorted")
+    except (ImportError, TypeError):
+        return None
+    encoder = msgspec.json.Encoder()
+    return FastCodec(
+        "msgspec", encoder.encode, sorted_encoder.encode, msgspec.json.decode
+    )
+
+
+# Backends available in this environment, by name
+CODECS: Dict[str, Codec] = {
+    codec.name: codec for codec in (STDLIB, orjson_codec(), msgspec_codec()) if codec
+}
+
+
+def get(name: Optional[str] = None) -> Codec:
+    """Codec by name, or the stdlib one by default"""
+    if name is None:
+        return STDLIB
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"JSON backend {name!r} is not available") from None
@@ -16,3 +16,7 @@ DEFAULT_PORT = 443
 ALT_PORT = 2197
 MAX_NOTIFICATION_PAYLOAD_SIZE_VOIP = 5120
 MAX_NOTIFICATION_PAYLOAD_SIZE_OTHER = 4096
+# Device tokens are sent as hex, 32 bytes today but Apple documents them as
+# variable length; bounds on the count of hex digits
+DEVICE_TOKEN_MIN_LENGTH = 64
+DEVICE_TOKEN_MAX_LENGTH = 200
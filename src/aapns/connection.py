@@ -2,24 +2,40 @@ from __future__ import annotations
 
 import asyncio
 import json
+import os
 import ssl
 from asyncio import CancelledError, TimeoutError, create_task, open_connection, wait_for
+from collections import OrderedDict
 from contextlib import suppress
 from dataclasses import dataclass, field
 from logging import getLogger
 from math import inf
 from ssl import OP_NO_TLSv1, OP_NO_TLSv1_1, SSLError, create_default_context
 from time import time
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
 from urllib.parse import urlparse
 
+import attr
 import h2.config
 import h2.connection
+import h2.errors
 import h2.events
 import h2.exceptions
 import h2.settings
 
-from .errors import Blocked, Closed, FormatError, ResponseTooLarge, StreamReset, Timeout
+from .codec import STDLIB, Codec
+from .errors import (
+    APNSError,
+    Blocked,
+    Closed,
+    FormatError,
+    ResponseTooLarge,
+    StreamReset,
+    Timeout,
+)
+
+if TYPE_CHECKING:
+    from .loopback import Recording
 
 # Apple limits APN payload (data) to 4KB or 5KB, depending.
 # Request header is not subject to flow control in HTTP/2
@@ -37,6 +53,8 @@ CONNECTION_WINDOW_SIZE = 1000 * MAX_RESPONSE_SIZE
 CONNECTION_TIMEOUT = 5
 TLS_TIMEOUT = 5
 logger = getLogger(__package__)
+# Completion callback for submitted requests, called with the response or error
+Callback = Callable[["Request", Union["Response", APNSError]], None]
 
 
 @dataclass(eq=False)
@@ -77,10 +95,19 @@ class Connection:
     max_concurrent_streams: int = 100  # initial per RFC7540#section-6.5.2
     last_stream_id_got: int = -1
     last_stream_id_sent: int = -1  # client streams are odd
+    streams: int = 0
+    header_bytes: int = 0  # HPACK encoded, including frame headers
+    outgoing: bytearray = field(default_factory=bytearray)  # taken from h2
+    codec: Codec = STDLIB
+    recording: Optional[Recording] = None  # of the bytes sent and received
 
     @classmethod
     async def create(
-        cls, origin: str, ssl: Optional[ssl.SSLContext] = None
+        cls,
+        origin: str,
+        ssl: Optional[ssl.SSLContext] = None,
+        codec: Codec = STDLIB,
+        recording: Optional[Recording] = None,
     ) -> Connection:
         """Connect to `origin` and return a Connection"""
         url = urlparse(origin)
@@ -108,6 +135,40 @@ class Connection:
 
         # https://bugs.python.org/issue40111 validate context h2 alpn
 
+        read_stream, write_stream = await wait_for(
+            open_connection(
+                host, port, ssl=ssl_context, ssl_handshake_timeout=TLS_TIMEOUT
+            ),
+            CONNECTION_TIMEOUT,
+        )
+        try:
+            info = write_stream.get_extra_info("ssl_object")
+            if not info:
+                raise Closed("Failed TLS handshake")
+            proto = info.selected_alpn_protocol()
+            if proto != "h2":
+                raise Closed("Failed to negotiate HTTP/2")
+        except Closed:
+            write_stream.close()
+            with suppress(SSLError, ConnectionError):
+                await write_stream.wait_closed()
+            raise
+
+        # FIXME we could wait for settings frame from the server,
+        # to tell us how much we can actually send, as initial window is small
+        return cls.over(read_stream, write_stream, host, port, codec, recording)
+
+    @classmethod
+    def over(
+        cls,
+        read_stream: asyncio.StreamReader,
+        write_stream: asyncio.StreamWriter,
+        host: str = "localhost",
+        port: int = 443,
+        codec: Codec = STDLIB,
+        recording: Optional[Recording] = None,
+    ) -> Connection:
+        """Connection over established streams, such as `loopback.pipe()`"""
         protocol = h2.connection.H2Connection(
             h2.config.H2Configuration(client_side=True, header_encoding="utf-8")
         )
@@ -130,28 +191,15 @@ class Connection:
         protocol.initiate_connection()
         protocol.increment_flow_control_window(CONNECTION_WINDOW_SIZE)
 
-        read_stream, write_stream = await wait_for(
-            open_connection(
-                host, port, ssl=ssl_context, ssl_handshake_timeout=TLS_TIMEOUT
-            ),
-            CONNECTION_TIMEOUT,
+        return cls(
+            host,
+            port,
+            protocol,
+            read_stream,
+            write_stream,
+            codec=codec,
+            recording=recording,
         )
-        try:
-            info = write_stream.get_extra_info("ssl_object")
-            if not info:
-                raise Closed("Failed TLS handshake")
-            proto = info.selected_alpn_protocol()
-            if proto != "h2":
-                raise Closed("Failed to negotiate HTTP/2")
-        except Closed:
-            write_stream.close()
-            with suppress(SSLError, ConnectionError):
-                await write_stream.wait_closed()
-            raise
-
-        # FIXME we could wait for settings frame from the server,
-        # to tell us how much we can actually send, as initial window is small
-        return cls(host, port, protocol, read_stream, write_stream)
 
     def __post_init__(self):
         self.should_write = asyncio.Event()
@@ -161,6 +209,51 @@ class Connection:
 
     async def post(self, request: "Request") -> "Response":
         """Post the `request` on the connection"""
+        wakeup: asyncio.Event = asyncio.Event()
+        events: List[h2.events.Event] = []
+        stream_id, channel = self.start(request, Channel(wakeup, events))
+
+        try:
+            while not self.closed:
+                remaining = request.get_time_left_or_fail()
+                wakeup.clear()
+                with suppress(TimeoutError):
+                    await wait_for(wakeup.wait(), remaining)
+                for event in events:
+                    if isinstance(event, h2.events.StreamEnded):
+                        return channel.response(self.codec)
+                    elif isinstance(event, h2.events.StreamReset):
+                        raise StreamReset()
+                    elif not channel.receive(event):
+                        raise ResponseTooLarge(f"Larger than {MAX_RESPONSE_SIZE}")
+                del events[:]
+            raise Closed(self.outcome)
+        finally:
+            # FIXME reset the stream, if:
+            # * connection is still alive, and
+            # * this stream did not end yet
+            # Must be very careful not to break the connection
+            # self.protocol.reset_stream(stream_id, 0)
+            # self.should_write.set()
+            del self.channels[stream_id]
+
+    def submit(self, request: "Request", callback: Callback):
+        """Post the `request` on the connection without waiting for the response
+
+        Rather, `callback(request, outcome)` is called with the `Response` or the
+        `APNSError` once the request is done, from the background reader task
+        or from a timer when the request times out. Raises `Blocked` or `Closed`
+        right away if the request can't be posted.
+        """
+        stream_id, channel = self.start(request, Channel(callback=callback))
+        channel.request = request
+        if request.deadline < inf:
+            channel.timer = asyncio.get_running_loop().call_later(
+                request.deadline - time(), self.expire, stream_id
+            )
+
+    def start(self, request: "Request", channel: "Channel"):
+        """Open a stream for the `request`, to be tracked in `channel`"""
         request.get_time_left_or_fail()
         if self.closing or self.closed:
             raise Closed(self.outcome)
@@ -179,40 +272,64 @@ class Connection:
 
         self.last_stream_id_got = stream_id
 
-        self.channels[stream_id] = channel = Channel()
+        self.channels[stream_id] = channel
+        request.sent = True
+        # h2 doesn't report the encoded header size: take out what it has
+        # buffered before and after, to be sent from `outgoing`
+        self.outgoing += self.protocol.data_to_send()
         self.protocol.send_headers(
             stream_id, request.header_with(self.host, self.port), end_stream=False
         )
+        headers = self.protocol.data_to_send()
+        self.streams += 1
+        self.header_bytes += len(headers)
+        self.outgoing += headers
         self.protocol.send_data(stream_id, request.body, end_stream=True)
         self.should_write.set()
 
+        return stream_id, channel
+
+    def dispatch(self, stream_id: int, channel: "Channel", event: h2.events.Event):
+        """Process an event for a submitted request"""
+        if isinstance(event, h2.events.StreamEnded):
+            try:
+                outcome: Union[Response, APNSError] = channel.response(self.codec)
+            except FormatError as e:
+                outcome = e
+            self.finish(stream_id, outcome)
+        elif isinstance(event, h2.events.StreamReset):
+            self.finish(stream_id, StreamReset())
+        elif not channel.receive(event):
+            self.finish(stream_id, ResponseTooLarge(f"Larger than {MAX_RESPONSE_SIZE}"))
+
+    def expire(self, stream_id: int):
+        if channel := self.channels.get(stream_id):
+            assert channel.request
+            self.finish(
+                stream_id,
+                Timeout("Request timed out: %s" % channel.request.deadline_source),
+            )
+
+    def finish(self, stream_id: int, outcome: Union[Response, APNSError]):
+        """Complete a submitted request"""
+        channel = self.channels.pop(stream_id, None)
+        if not channel or not channel.callback:
+            return
+        assert channel.request
+        if channel.timer:
+            channel.timer.cancel()
         try:
-            while not self.closed:
-                remaining = request.get_time_left_or_fail()
-                channel.wakeup.clear()
-                with suppress(TimeoutError):
-                    await wait_for(channel.wakeup.wait(), remaining)
-                for event in channel.events:
-                    if isinstance(event, h2.events.ResponseReceived):
-                        channel.header = dict(event.headers)
-                    elif isinstance(event, h2.events.DataReceived):
-                        channel.body += event.data
-                        if len(channel.body) >= MAX_RESPONSE_SIZE:
-                            raise ResponseTooLarge(f"Larger than {MAX_RESPONSE_SIZE}")
-                    elif isinstance(event, h2.events.StreamEnded):
-                        return Response.new(channel.header, channel.body)
-                    elif isinstance(event, h2.events.StreamReset):
-                        raise StreamReset()
-                del channel.events[:]
-            raise Closed(self.outcome)
-        finally:
-            # FIXME reset the stream, if:
-            # * connection is still alive, and
-            # * this stream did not end yet
-            # Must be very careful not to break the connection
-            # self.protocol.reset_stream(stream_id, 0)
-            # self.should_write.set()
-            del self.channels[stream_id]
+            channel.callback(channel.request, outcome)
+        except Exception:
+            logger.exception("Completion callback failed")
+
+    def release_all(self):
+        """Release or cancel all pending requests, once the connection is closed"""
+        for stream_id, channel in list(self.channels.items()):
+            if channel.callback:
+                self.finish(stream_id, Closed(self.outcome))
+            elif channel.wakeup:
+                channel.wakeup.set()
 
     async def close(self):
         """Terminate the connection and free up the resources"""
@@ -235,8 +352,7 @@ class Connection:
             self.should_write.set()
 
             # at this point, we must release or cancel all pending requests
-            for channel in self.channels.values():
-                channel.wakeup.set()
+            self.release_all()
 
             self.write_stream.close()
             with suppress(SSLError, ConnectionError):
@@ -292,59 +408,7 @@ class Connection:
                 data = await self.read_stream.read(2 ** 16)
                 if not data:
                     raise ConnectionError("Server closed the connection")
-
-                for event in self.protocol.receive_data(data):
-                    logger.debug("APN: %s", event)
-                    stream_id = getattr(event, "stream_id", 0)
-                    error = getattr(event, "error_code", None)
-                    channel = self.channels.get(stream_id)
-
-                    if isinstance(event, h2.events.RemoteSettingsChanged):
-                        m = event.changed_settings.get(
-                            h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS
-                        )
-                        if m:
-                            self.max_concurrent_streams = m.new_value
-                    elif isinstance(event, h2.events.ConnectionTerminated):
-                        # When Apple is not happy with the whole connection,
-                        # it sends smth like {"reason": "BadCertificateEnvironment"}
-                        # Catch it here, so that connection pool can be invalidated.
-                        self.closing = True
-                        if not self.outcome:
-                            if event.additional_data:
-                                try:
-                                    self.outcome = json.loads(
-                                        event.additional_data.decode("utf-8")
-                                    )["reason"]
-                                except Exception:
-                                    self.outcome = str(event.additional_data[:100])
-                            else:
-                                self.outcome = str(event.error_code)
-                        logger.info("Closing with %s", self.outcome)
-                    elif not stream_id and error is not None:
-                        logger.warning("Caught off guard: %s", event)
-                        raise ConnectionError(str(error))
-                    else:
-                        if isinstance(event, h2.events.DataReceived):
-                            # Stream flow control is responsibility of the channel.
-                            # Connection flow control is handled here.
-                            self.protocol.acknowledge_received_data(
-                                event.flow_controlled_length, stream_id
-                            )
-                        if channel:
-                            channel.events.append(event)
-                            channel.wakeup.set()
-
-                # Somewhat inefficient: wake up background writer just in case
-                # it could be that we've received something that h2 needs to acknowledge
-                self.should_write.set()
-
-                # FIXME notify pool users about possible change to `.blocked`
-                # * h2.events.WindowUpdated
-                # * max_concurrent_streams change
-                # * [maybe] starting a stream
-                # * a stream getting closed (but not half-closed)
-                # * closing / closed change
+                self.receive(data)
         except ConnectionError as e:
             if not self.outcome:
                 self.outcome = str(e)
@@ -353,8 +417,71 @@ class Connection:
         finally:
             self.closing = self.closed = True
             self.should_write.set()
-            for channel in self.channels.values():
-                channel.wakeup.set()
+            self.release_all()
+
+    def receive(self, data: bytes):
+        """Process bytes received from the server"""
+        if self.recording is not None:
+            self.recording.received(data)
+        for event in self.protocol.receive_data(data):
+            logger.debug("APN: %s", event)
+            stream_id = getattr(event, "stream_id", 0)
+            error = getattr(event, "error_code", None)
+            channel = self.channels.get(stream_id)
+
+            if isinstance(event, h2.events.RemoteSettingsChanged):
+                m = event.changed_settings.get(
+                    h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS
+                )
+                if m:
+                    self.max_concurrent_streams = m.new_value
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                # When Apple is not happy with the whole connection,
+                # it sends smth like {"reason": "BadCertificateEnvironment"}
+                # Catch it here, so that connection pool can be invalidated.
+                self.closing = True
+                if not self.outcome:
+                    if event.additional_data:
+                        try:
+                            self.outcome = json.loads(
+                                event.additional_data.decode("utf-8")
+                            )["reason"]
+                        except Exception:
+                            self.outcome = str(event.additional_data[:100])
+                    else:
+                        self.outcome = error_name(event.error_code)
+                logger.info("Closing with %s", self.outcome)
+            elif not stream_id and error is not None:
+                logger.warning("Caught off guard: %s", event)
+                raise ConnectionError(str(error))
+            else:
+                if isinstance(event, h2.events.DataReceived):
+                    # Stream flow control is responsibility of the channel.
+                    # Connection flow control is handled here.
+                    self.protocol.acknowledge_received_data(
+                        event.flow_controlled_length, stream_id
+                    )
+                if channel and channel.callback:
+                    self.dispatch(stream_id, channel, event)
+                elif channel and channel.wakeup and channel.events is not None:
+                    channel.events.append(event)
+                    channel.wakeup.set()
+
+        # Somewhat inefficient: wake up background writer just in case
+        # it could be that we've received something that h2 needs to acknowledge
+        self.should_write.set()
+
+        # FIXME notify pool users about possible change to `.blocked`
+        # * h2.events.WindowUpdated
+        # * max_concurrent_streams change
+        # * [maybe] starting a stream
+        # * a stream getting closed (but not half-closed)
+        # * closing / closed change
+
+    def data_to_send(self) -> bytes:
+        data = bytes(self.outgoing) + self.protocol.data_to_send()
+        self.outgoing.clear()
+        return data
 
     async def background_write(self):
         try:
@@ -365,7 +492,9 @@ class Connection:
                     if self.closed:
                         return
 
-                    if data := self.protocol.data_to_send():
+                    if data := self.data_to_send():
+                        if self.recording is not None:
+                            self.recording.sent(data)
                         self.write_stream.write(data)
                         last_stream_id = self.last_stream_id_got
                         await self.write_stream.drain()
@@ -383,20 +512,43 @@ class Connection:
             self.closing = self.closed = True
 
 
-@dataclass
+@attr.s(auto_attribs=True, slots=True)
 class Channel:
-    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
-    events: List[h2.events.Event] = field(default_factory=list)
-    header: Optional[dict] = None
-    body: bytes = b""
-
-
-@dataclass
+    """Per stream state, kept small as there's one for every pending request"""
+
+    # for posted requests only, submitted ones are handled as events arrive
+    wakeup: Optional[asyncio.Event] = None
+    events: Optional[List[h2.events.Event]] = None
+    header: Optional[list] = None  # as received, a list of (name, value)
+    body: Optional[bytearray] = None  # allocated on the first data frame
+    # for submitted requests only
+    callback: Optional[Callback] = None
+    request: Optional[Request] = None
+    timer: Optional[asyncio.TimerHandle] = None
+
+    def receive(self, event: h2.events.Event) -> bool:
+        """Record response header or data, False if the response is too large"""
+        if isinstance(event, h2.events.ResponseReceived):
+            self.header = event.headers
+        elif isinstance(event, h2.events.DataReceived):
+            if self.body is None:
+                self.body = bytearray(event.data)
+            else:
+                self.body += event.data
+            return len(self.body) < MAX_RESPONSE_SIZE
+        return True
+
+    def response(self, codec: Codec) -> Response:
+        return Response.parse(self.header or (), bytes(self.body or b""), codec)
+
+
+@attr.s(auto_attribs=True, slots=True)
 class Request:
     header: tuple
     body: bytes
     deadline: float
     deadline_source: str
+    sent: bool = False  # handed to a connection at least once
 
     def header_with(self, host: str, port: int) -> tuple:
         """Request header including :authority pseudo header field for target server"""
@@ -417,57 +569,106 @@ class Request:
         timeout: Optional[float] = 10,
         deadline: Optional[float] = None,
         expiration: Optional[float] = None,
+        codec: Codec = STDLIB,
+    ) -> Request:
+        body = codec.dumps(data)
+        return cls.encoded(
+            path, tuple(header.items()), body, timeout, deadline, expiration
+        )
+
+    @classmethod
+    def encoded(
+        cls,
+        path: str,
+        header: tuple,
+        body: bytes,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+        expiration: Optional[float] = None,
     ) -> Request:
+        """Like `Request.new`, but with header items and body already encoded"""
         if not path.startswith("/"):
             raise ValueError("Absolute URL path is required")
 
-        deadlines = {"not set": inf}
-        if timeout is not None:
-            deadlines["timeout"] = time() + timeout
-        if deadline is not None:
-            deadlines["deadline"] = deadline
-        if expiration is not None:
-            deadlines["expiration"] = expiration
-        deadline = min(deadlines.values())
-        deadline_source = [name for name, v in deadlines.items() if v == deadline][0]
+        effective, deadline_source = inf, "not set"
+        if timeout is not None and (at := time() + timeout) < effective:
+            effective, deadline_source = at, "timeout"
+        if deadline is not None and deadline < effective:
+            effective, deadline_source = deadline, "deadline"
+        if expiration is not None and expiration < effective:
+            effective, deadline_source = expiration, "expiration"
 
         request_header = (
             (":method", "POST"),
             (":scheme", "https"),
             (":path", path),
-            *header.items(),
+            *header,
         )
-
-        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode(
-            "utf-8"
-        )
-        return cls(request_header, body, deadline, deadline_source)
+        return cls(request_header, body, effective, deadline_source)
 
 
-@dataclass
+@attr.s(auto_attribs=True, slots=True)
 class Response:
+    """Server response, only `code`, `apns_id` and `apns_unique_id` are parsed
+
+    The body is decoded for error responses only, successful ones are empty.
+    """
+
     code: int
-    header: Dict[str, str]
+    apns_id: Optional[str]
+    apns_unique_id: Optional[str]
     data: Optional[dict]
+    raw_header: Sequence[Tuple[str, str]] = ()
 
     @classmethod
-    def new(cls, header: Optional[dict], body: bytes) -> Response:
-        head = {**(header or {})}
-        code = int(head.pop(":status", "0"))
-        try:
-            return cls(code, head, json.loads(body) if body else None)
-        except json.JSONDecodeError:
-            raise FormatError(f"Not JSON: {body[:20]!r}")
+    def new(
+        cls, header: Optional[dict], body: bytes, codec: Codec = STDLIB
+    ) -> Response:
+        return cls.parse(tuple((header or {}).items()), body, codec)
+
+    @classmethod
+    def parse(
+        cls, header: Sequence[Tuple[str, str]], body: bytes, codec: Codec = STDLIB
+    ) -> Response:
+        """Response from the header list as received and the body"""
+        code, apns_id, apns_unique_id = 0, None, None
+        for name, value in header:
+            if name == ":status":
+                code = int(value)
+            elif name == "apns-id":
+                apns_id = value
+            elif name == "apns-unique-id":
+                apns_unique_id = value
+        data = None
+        if body and code != 200:
+            try:
+                data = codec.loads(body)
+            except ValueError:
+                raise FormatError(f"Not JSON: {body[:20]!r}")
+        return cls(code, apns_id, apns_unique_id, data, header)
 
     @property
-    def apns_id(self) -> Optional[str]:
-        return self.header.get("apns-id", None)
+    def header(self) -> Dict[str, str]:
+        """Response header fields, without the `:status` pseudo field"""
+        return {k: v for k, v in self.raw_header if k != ":status"}
 
     @property
     def reason(self) -> Optional[str]:
         """Response JSON 'reason' value, used in error responses."""
         return self.data.get("reason") if self.data else None
 
+    @property
+    def timestamp(self) -> Optional[int]:
+        """Response JSON 'timestamp' value, set for `Unregistered` responses."""
+        return self.data.get("timestamp") if self.data else None
+
+
+def error_name(code) -> str:
+    """Like "ErrorCodes.NO_ERROR", as str() of an IntEnum is the number in 3.11"""
+    if isinstance(code, h2.errors.ErrorCodes):
+        return f"ErrorCodes.{code.name}"
+    return str(code)
+
 
 def create_ssl_context() -> ssl.SSLContext:
     """A basic SSL context suitable for HTTP/2 and APN."""
@@ -476,3 +677,38 @@ def create_ssl_context() -> ssl.SSLContext:
     context.options |= OP_NO_TLSv1_1
     context.set_alpn_protocols(["h2"])
     return context
+
+
+def cached_ssl_context(certfile: str, cafile: Optional[str] = None) -> ssl.SSLContext:
+    """SSL context with the client certificate and optional CA file, cached
+
+    Contexts are reused until the files change (by modification time, size
+    or inode), so that pools with the same credentials share one, and the PEM
+    files are only parsed once. The returned context is shared, callers must
+    not modify it; use `create_ssl_context` for one to customise.
+    """
+    key = (certfile, cafile)
+    stamp = tuple(file_stamp(path) for path in key if path)
+    if (entry := SSL_CONTEXTS.get(key)) and entry[0] == stamp:
+        SSL_CONTEXTS.move_to_end(key)
+        return entry[1]
+    context = create_ssl_context()
+    if cafile:
+        context.load_verify_locations(cafile=cafile)
+    context.load_cert_chain(certfile=certfile, keyfile=certfile)
+    SSL_CONTEXTS[key] = (stamp, context)
+    SSL_CONTEXTS.move_to_end(key)
+    while len(SSL_CONTEXTS) > SSL_CONTEXT_CACHE_SIZE:
+        SSL_CONTEXTS.popitem(last=False)
+    return context
+
+
+def file_stamp(path: str) -> Tuple[int, int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+SSL_CONTEXT_CACHE_SIZE = 1024
+SSL_CONTEXTS: OrderedDict[
+    Tuple[str, Optional[str]], Tuple[tuple, ssl.SSLContext]
+] = OrderedDict()
@@ -9,6 +9,10 @@ class Blocked(APNSError):
     """This connection can't send more data at this point, can try later."""
 
 
+class RateLimited(Blocked):
+    """Request was rejected by the local rate limiter, can try later."""
+
+
 class Closed(APNSError):
     """This connection is now closed, try another."""
 
@@ -78,6 +82,8 @@ TooManyRequests = create("TooManyRequests")
 InternalServerError = create("InternalServerError")
 ServiceUnavailable = create("ServiceUnavailable")
 Shutdown = create("Shutdown")
+# Not sent by the server: the token was rejected locally, see aapns.suppression
+Suppressed = create("Suppressed")
 
 
 def get(reason: Any, apns_id: Optional[str]) -> ResponseError:
@@ -0,0 +1,235 @@
+"""Scripted fault scenarios against the stub server
+
+`run` sends a steady load of notifications through a `Pool` or an `APNS`
+client to a `StubServer`. After `before` seconds a fault is injected for
+`duration` seconds, then cleared, and the load goes on for `after` seconds:
+
+    report = await run(SCENARIOS["goaway-storm"], certfile, keyfile, client_cert)
+    print(report.summary())
+
+The report has the goodput, the error amplification (requests the server
+received per notification sent), the time to recover after the fault and the
+peaks of the pool's `pending` and `retrying` counts. Scenarios are plain
+coroutines, more can be written for the faults the stub supports.
+"""
+from __future__ import annotations
+
+import asyncio
+from asyncio import create_task, gather, sleep
+from collections import Counter
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from .api import APNS
+from .connection import Request, cached_ssl_context
+from .errors import APNSError, ResponseError
+from .models import Alert, Notification
+from .pool import Pool
+from .stub import StubServer
+
+# Fault(stub, duration) injects the fault, and clears it after `duration`
+Fault = Callable[[StubServer, float], Coroutine[Any, Any, None]]
+# Sampling interval for recovery and peaks, in seconds
+INTERVAL = 0.1
+# Custom data in each notification, so that flow control windows matter
+PADDING = 1000
+
+
+async def slow_responses(stub: StubServer, duration: float):
+    latency, stub.latency = stub.latency, lambda rng: 0.5 + rng.random()
+    await sleep(duration)
+    stub.latency = latency
+
+
+async def goaway_storm(stub: StubServer, duration: float):
+    """GOAWAY on every connection, several times a second"""
+    end = perf_counter() + duration
+    while perf_counter() < end:
+        stub.go_away()
+        await sleep(0.2)
+
+
+async def window_starvation(stub: StubServer, duration: float):
+    """Flow control windows are credited back only after the fault"""
+    stub.window_update_delay = duration
+    await sleep(duration)
+    stub.window_update_delay = 0.0
+
+
+async def reset_streams(stub: StubServer, duration: float):
+    stub.reset_streams = 0.5
+    await sleep(duration)
+    stub.reset_streams = 0.0
+
+
+async def handshake_failures(stub: StubServer, duration: float):
+    """Connections drop, and can't be replaced until the fault clears"""
+    stub.handshake_failures = 2 ** 31
+    for connection in list(stub.connections):
+        connection.abort()
+    await sleep(duration)
+    stub.handshake_failures = 0
+
+
+async def too_many_requests(stub: StubServer, duration: float):
+    reasons, stub.reasons = stub.reasons, {"TooManyRequests": 1.0}
+    await sleep(duration)
+    stub.reasons = reasons
+
+
+SCENARIOS: Dict[str, Fault] = {
+    "slow-responses": slow_responses,
+    "goaway-storm": goaway_storm,
+    "window-starvation": window_starvation,
+    "reset-streams": reset_streams,
+    "handshake-failures": handshake_failures,
+    "too-many-requests": too_many_requests,
+}
+
+
+@dataclass
+class Report:
+    scenario: str
+    client: str
+    sent: int = 0
+    received: int = 0  # by the server, including retries
+    # completion time, and whether the notification was delivered
+    completions: List[Tuple[float, bool]] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)  # by error class or reason
+    seconds: float = 0.0
+    recovery: Optional[float] = None
+    peak_pending: int = 0
+    peak_retrying: int = 0
+
+    @property
+    def delivered(self) -> int:
+        return sum(ok for at, ok in self.completions)
+
+    @property
+    def goodput(self) -> float:
+        """Notifications delivered per second"""
+        return self.delivered / self.seconds if self.seconds else 0.0
+
+    @property
+    def amplification(self) -> float:
+        """Requests the server received per notification sent"""
+        return self.received / self.sent if self.sent else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        return dict(
+            scenario=self.scenario,
+            client=self.client,
+            sent=self.sent,
+            delivered=self.delivered,
+            goodput=round(self.goodput),
+            amplification=round(self.amplification, 3),
+            recovery=None if self.recovery is None else round(self.recovery, 2),
+            peak_pending=self.peak_pending,
+            peak_retrying=self.peak_retrying,
+            errors=dict(self.errors),
+        )
+
+    def measure_recovery(self, start: float, fault_start: float, fault_end: float):
+        """Seconds from the end of the fault until the first interval that
+        delivers 90% of the rate before the fault, or None"""
+        buckets: Counter = Counter()
+        for at, ok in self.completions:
+            buckets[int((at - start) / INTERVAL)] += ok
+        first, last = int((fault_start - start) / INTERVAL), max(buckets, default=0)
+        baseline = sum(buckets[i] for i in range(1, first)) / max(first - 1, 1)
+        for i in range(int((fault_end - start) / INTERVAL), last + 1):
+            if buckets[i] >= 0.9 * baseline:
+                self.recovery = max(0.0, start + (i + 1) * INTERVAL - fault_end)
+                return
+
+
+async def run(
+    fault: Fault,
+    certfile: str,
+    keyfile: str,
+    client_cert: str,
+    *,
+    client: str = "pool",
+    rate: int = 500,
+    before: float = 1.0,
+    duration: float = 1.0,
+    after: float = 2.0,
+    size: int = 2,
+    timeout: float = 5.0,
+    seed: Optional[int] = 1,
+) -> Report:
+    """Run the `fault` scenario with `rate` notifications per second
+
+    `client` is "pool" to post requests to a `Pool`, or "apns" to send
+    notifications with an `APNS` client. Notifications still pending at the
+    end are waited for, up to their `timeout`.
+    """
+    name = next((k for k, v in SCENARIOS.items() if v is fault), fault.__name__)
+    report = Report(name, client)
+    async with StubServer(certfile, keyfile, seed=seed) as stub:
+        ssl = cached_ssl_context(client_cert, certfile)
+        pool = await Pool.create(stub.origin, size, ssl)
+        apns = APNS(pool)
+        notification = Notification(
+            alert=Alert(body="Something happened"), extra={"data": "x" * PADDING}
+        )
+
+        async def send(i: int):
+            token = f"{i:064x}"
+            try:
+                if client == "apns":
+                    await apns.send_notification(
+                        token, notification, topic="com.example.app", timeout=timeout
+                    )
+                    ok = True
+                else:
+                    response = await pool.post(
+                        Request.new(
+                            f"/3/device/{token}",
+                            {"apns-topic": "com.example.app"},
+                            notification.get_dict(),
+                            timeout=timeout,
+                        )
+                    )
+                    ok = response.code == 200
+                    if not ok:
+                        report.errors[response.reason] += 1
+            except ResponseError as e:
+                ok = False
+                report.errors[e.reason] += 1
+            except APNSError as e:
+                ok = False
+                report.errors[type(e).__name__] += 1
+            report.completions.append((perf_counter(), ok))
+
+        async def sample():
+            while True:
+                report.peak_pending = max(report.peak_pending, pool.pending)
+                report.peak_retrying = max(report.peak_retrying, pool.retrying)
+                await sleep(INTERVAL / 10)
+
+        sampler = create_task(sample())
+        tasks: List[asyncio.Task] = []
+        injected: Optional[asyncio.Task] = None
+        try:
+            start = perf_counter()
+            fault_start, fault_end = start + before, start + before + duration
+            end = fault_end + after
+            while (now := perf_counter()) < end:
+                if not injected and now >= fault_start:
+                    injected = create_task(fault(stub, duration))
+                while report.sent < (now - start) * rate:
+                    tasks.append(create_task(send(report.sent)))
+                    report.sent += 1
+                await sleep(INTERVAL / 10)
+            await gather(*tasks)
+            report.seconds = perf_counter() - start
+            if injected:
+                await injected
+        finally:
+            sampler.cancel()
+            await pool.close()
+        report.received = stub.requests
+    report.measure_recovery(start, fault_start, fault_end)
+    return report
@@ -0,0 +1,209 @@
+"""In-memory transport, and recording and replay of HTTP/2 byte streams
+
+`pipe()` makes a pair of connected stream ends without sockets or TLS, for
+`Connection.over(...)`; `StubServer.pipe()` serves one end. Benchmarks over
+pipes measure the Python side only.
+
+A `Recording` captures the bytes a connection sends and receives:
+
+    recording = Recording()
+    connection = await Connection.create(origin, ssl, recording=recording)
+    ...
+    recording.save("session.h2")
+
+`replay(Recording.load("session.h2"))` submits the recorded requests on a
+new connection, and feeds it the recorded bytes received, in the same order
+and without any I/O, so that h2 parsing, dispatch and building responses can
+be profiled deterministically.
+"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from pathlib import Path
+from struct import Struct
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.settings
+
+from .codec import STDLIB, Codec
+from .connection import Connection, Request, Response
+from .errors import APNSError
+
+End = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+# Replay step: bytes received, or requests sent
+Step = Tuple[bytes, List[Request]]
+# Recording file chunk header: received flag and length
+CHUNK = Struct("!?I")
+
+
+class MemoryTransport(asyncio.Transport):
+    """Transport that hands writes straight to the peer's protocol"""
+
+    def __init__(self, protocol: asyncio.Protocol):
+        super().__init__()
+        self.protocol = protocol
+        self.peer: Optional[MemoryTransport] = None
+        self.closing = False
+
+    def write(self, data: Any):
+        if self.peer and not self.closing and not self.peer.closing:
+            self.peer.protocol.data_received(bytes(data))
+
+    def write_eof(self):
+        if self.peer and not self.peer.closing:
+            self.peer.protocol.eof_received()
+
+    def can_write_eof(self) -> bool:
+        return True
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        """Close both ends, like a socket"""
+        if self.closing:
+            return
+        self.closing = True
+        asyncio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+        if self.peer:
+            self.peer.close()
+
+    abort = close
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+def pipe() -> Tuple[End, End]:
+    """Two connected `(reader, writer)` ends"""
+    loop = asyncio.get_running_loop()
+    readers = asyncio.StreamReader(), asyncio.StreamReader()
+    protocols = [asyncio.StreamReaderProtocol(reader) for reader in readers]
+    a, b = transports = [MemoryTransport(protocol) for protocol in protocols]
+    a.peer, b.peer = b, a
+    ends = []
+    for reader, protocol, transport in zip(readers, protocols, transports):
+        protocol.connection_made(transport)
+        ends.append((reader, asyncio.StreamWriter(transport, protocol, reader, loop)))
+    return ends[0], ends[1]
+
+
+@dataclass
+class Recording:
+    """Chunks of bytes sent and received on a connection, in order"""
+
+    chunks: List[Tuple[bool, bytes]] = field(default_factory=list)  # (received, data)
+    decoded: Optional[List[Step]] = field(default=None, repr=False, compare=False)
+
+    def sent(self, data: bytes):
+        self.chunks.append((False, bytes(data)))
+
+    def received(self, data: bytes):
+        self.chunks.append((True, bytes(data)))
+
+    def save(self, path: Union[str, Path]):
+        with open(path, "wb") as f:
+            for received, data in self.chunks:
+                f.write(CHUNK.pack(received, len(data)))
+                f.write(data)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Recording:
+        blob = Path(path).read_bytes()
+        chunks, offset = [], 0
+        while offset < len(blob):
+            received, size = CHUNK.unpack_from(blob, offset)
+            offset += CHUNK.size
+            chunks.append((received, blob[offset : offset + size]))
+            offset += size
+        return cls(chunks)
+
+    def requests(self) -> List[Request]:
+        """Requests sent, decoded from the bytes sent, without deadlines"""
+        return [request for data, requests in self.steps() for request in requests]
+
+    def steps(self) -> List[Step]:
+        """Bytes received, or requests sent, in order; decoded once"""
+        if self.decoded is None:
+            decoder = RequestDecoder()
+            self.decoded = [
+                (data, []) if received else (b"", decoder.decode(data))
+                for received, data in self.chunks
+            ]
+        return self.decoded
+
+
+@dataclass
+class RequestDecoder:
+    """Server side of a recorded connection, rebuilding the requests sent"""
+
+    protocol: h2.connection.H2Connection = field(init=False)
+    streams: Dict[int, Tuple[list, bytearray]] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.protocol = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        self.protocol.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 2 ** 31 - 1,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: 2 ** 31 - 1,
+            },
+        )
+        self.protocol.initiate_connection()
+        self.protocol.increment_flow_control_window(2 ** 31 - 1 - 65535)
+
+    def decode(self, data: bytes) -> List[Request]:
+        """Requests completed by these bytes"""
+        requests = []
+        for event in self.protocol.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                self.streams[event.stream_id] = (event.headers, bytearray())
+            elif isinstance(event, h2.events.DataReceived):
+                self.streams[event.stream_id][1].extend(event.data)
+                self.protocol.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+            elif isinstance(event, h2.events.StreamEnded):
+                # h2 counts open streams by iterating over them, keep few
+                self.protocol.reset_stream(event.stream_id)
+                header, body = self.streams.pop(event.stream_id)
+                path = next(value for name, value in header if name == ":path")
+                fields = tuple((k, v) for k, v in header if not k.startswith(":"))
+                requests.append(Request.encoded(path, fields, bytes(body), None))
+        self.protocol.data_to_send()
+        return requests
+
+
+async def replay(
+    recording: Recording, codec: Codec = STDLIB
+) -> List[Tuple[Request, Union[Response, APNSError]]]:
+    """Replay a recorded connection, see the module documentation
+
+    Returns the requests and their outcomes, in the order they completed.
+    The requests are decoded on the first replay of a recording only.
+    """
+    outcomes: List[Tuple[Request, Union[Response, APNSError]]] = []
+    steps = recording.steps()
+    (reader, writer), _ = pipe()
+    connection = Connection.over(reader, writer, codec=codec)
+    try:
+        for data, requests in steps:
+            if data:
+                connection.receive(data)
+            for request in requests:
+                connection.submit(request, lambda *outcome: outcomes.append(outcome))
+    finally:
+        await connection.close()
+    return outcomes
@@ -0,0 +1,233 @@
+"""Connection pools for many tenants, each with its own client certificate
+
+`PoolManager` creates a pool per `Server` (client certificate and origin)
+when it's first used, and closes it once it's been idle for a while, or when
+room is needed for another tenant's pool under the global connection cap.
+
+Requests from all tenants share `max_inflight` slots. Once they are all
+taken, waiting requests get the freed slots in round-robin order across
+tenants, so that a blast for one tenant doesn't starve the others.
+"""
+from __future__ import annotations
+
+import asyncio
+from asyncio import CancelledError, create_task, shield, sleep
+from collections import OrderedDict, deque
+from contextlib import suppress
+from dataclasses import dataclass, field
+from itertools import count
+from logging import getLogger
+from time import monotonic
+from typing import Any, Deque, Optional
+
+from .api import APNS, Server
+from .connection import Request, Response
+from .errors import Closed, Timeout
+from .pool import Pool
+
+logger = getLogger(__package__)
+
+
+@dataclass(eq=False)
+class Tenant:
+    server: Server
+    pool: Optional[Pool] = None
+    creating: Optional[asyncio.Task] = None
+    pending: int = 0
+    last_used: float = field(default_factory=monotonic)
+    waiters: Deque[asyncio.Future] = field(default_factory=deque)
+
+    @property
+    def connections(self) -> int:
+        """Connections used or about to be used by this tenant"""
+        return self.server.pool_size if self.pool or self.creating else 0
+
+
+@dataclass(eq=False)
+class PoolManager:
+    """Connection pools keyed by `Server`, created on demand
+
+    Pools idle for `idle_timeout` seconds are closed. At most `max_connections`
+    connections are open across all pools; if a new pool doesn't fit, the least
+    recently used idle pools are closed to make room, or the request waits for
+    some pool to become idle.
+
+    Example use:
+
+        manager = PoolManager(max_connections=200)
+        client = manager.client(Server.production(tenant_cert_path))
+        await client.send_notification(token, notification)
+        ...
+        await manager.close()
+    """
+
+    max_connections: int = 100
+    max_inflight: int = 10_000
+    idle_timeout: float = 300
+    tenants: OrderedDict[Server, Tenant] = field(default_factory=OrderedDict)
+    ready: OrderedDict[Server, None] = field(default_factory=OrderedDict)
+    inflight: int = 0
+    closing_connections: int = 0
+    closing: bool = False
+    maintenance: asyncio.Task = field(init=False)
+
+    def __post_init__(self):
+        if self.max_connections < 1 or self.max_inflight < 1:
+            raise ValueError("Connection and request limits must be strictly positive")
+        self.maintenance = create_task(self.maintain(), name="manager-maintenance")
+
+    def client(self, server: Server, **kwargs: Any) -> APNS:
+        """Client for the `server` tenant, see `APNS` for the keyword arguments"""
+        return APNS(TenantPool(self, server), **kwargs)
+
+    @property
+    def connections(self) -> int:
+        return self.closing_connections + sum(
+            tenant.connections for tenant in self.tenants.values()
+        )
+
+    async def post(self, server: Server, request: Request) -> Response:
+        """Post the `request` on the pool for `server`, creating it if needed"""
+        if self.closing:
+            raise Closed("Pool manager closed")
+        if not (tenant := self.tenants.get(server)):
+            tenant = self.tenants[server] = Tenant(server)
+        self.tenants.move_to_end(server)
+        tenant.pending += 1
+        try:
+            await self.acquire(tenant, request)
+            try:
+                pool = await self.pool_for(tenant, request)
+                return await pool.post(request)
+            finally:
+                self.inflight -= 1
+                self.grant()
+        finally:
+            tenant.pending -= 1
+            tenant.last_used = monotonic()
+
+    async def acquire(self, tenant: Tenant, request: Request):
+        """Wait for an inflight slot, in turn with other tenants"""
+        if self.inflight < self.max_inflight and not self.ready:
+            self.inflight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        tenant.waiters.append(waiter)
+        self.ready.setdefault(tenant.server)
+        try:
+            await asyncio.wait_for(shield(waiter), request.get_time_left_or_fail())
+        except (asyncio.TimeoutError, CancelledError) as e:
+            if waiter.done():
+                # got the slot just too late, pass it on
+                self.inflight -= 1
+                self.grant()
+            waiter.cancel()
+            if isinstance(e, CancelledError):
+                raise
+            raise Timeout("Request timed out awaiting its turn")
+
+    def grant(self):
+        """Hand out free inflight slots to waiting tenants, round-robin"""
+        while self.inflight < self.max_inflight and self.ready:
+            server, _ = self.ready.popitem(last=False)
+            if not (tenant := self.tenants.get(server)):
+                continue
+            while tenant.waiters:
+                waiter = tenant.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    self.inflight += 1
+                    break
+            if tenant.waiters:
+                self.ready[server] = None
+
+    async def pool_for(self, tenant: Tenant, request: Request) -> Pool:
+        for delay in (10 ** i for i in count(-3, 0.5)):
+            if tenant.pool and not tenant.pool.closing:
+                return tenant.pool
+            if not tenant.creating:
+                # Counts against the cap from here on, before anything is awaited
+                tenant.creating = create_task(self.create_pool(tenant))
+            if pool := await shield(tenant.creating):
+                return pool
+            if request.get_time_left_or_fail() < delay:
+                raise Timeout("Request would time out awaiting a connection")
+            await sleep(delay)
+        assert False, "unreachable"
+
+    async def create_pool(self, tenant: Tenant) -> Optional[Pool]:
+        """Make room for the tenant's pool and create it, None if it won't fit"""
+        server = tenant.server
+        try:
+            if not await self.make_room():
+                return None
+            if tenant.pool:
+                await tenant.pool.close()
+            tenant.pool = await Pool.create(
+                server.origin, size=server.pool_size, ssl=server.create_ssl_context()
+            )
+            return tenant.pool
+        finally:
+            tenant.creating = None
+
+    async def make_room(self) -> bool:
+        """Close least recently used idle pools until the connections fit the cap"""
+        for server, tenant in list(self.tenants.items()):
+            if self.connections <= self.max_connections:
+                break
+            if (
+                self.tenants.get(server) is tenant
+                and tenant.pool
+                and not tenant.pending
+                and not tenant.creating
+            ):
+                await self.evict(server)
+        return self.connections <= self.max_connections
+
+    async def evict(self, server: Server):
+        if not (tenant := self.tenants.pop(server, None)):
+            return
+        self.ready.pop(server, None)
+        if tenant.pool:
+            # Its connections count against the cap until they are closed
+            self.closing_connections += server.pool_size
+            try:
+                await tenant.pool.close()
+            finally:
+                self.closing_connections -= server.pool_size
+
+    async def maintain(self):
+        while not self.closing:
+            await sleep(min(self.idle_timeout / 4, 10))
+            cutoff = monotonic() - self.idle_timeout
+            for server, tenant in list(self.tenants.items()):
+                if not tenant.pending and tenant.last_used < cutoff:
+                    try:
+                        await self.evict(server)
+                    except Exception:
+                        logger.exception("Failed closing idle pool")
+
+    async def close(self):
+        """Close all the pools"""
+        self.closing = True
+        self.maintenance.cancel()
+        with suppress(CancelledError):
+            await self.maintenance
+        await asyncio.gather(
+            *(self.evict(server) for server in list(self.tenants)),
+            return_exceptions=True,
+        )
+
+
+@dataclass(frozen=True)
+class TenantPool:
+    """One tenant's view of a `PoolManager`, for use with `APNS`"""
+
+    manager: PoolManager
+    server: Server
+
+    async def post(self, request: Request) -> Response:
+        return await self.manager.post(self.server, request)
+
+    async def close(self):
+        """The pool belongs to the manager, see `PoolManager.close`"""
@@ -1,11 +1,18 @@
 import json
+from bisect import bisect_right
 from enum import Enum, unique
+from functools import lru_cache
+from itertools import accumulate
+from json.encoder import ESCAPE_DCT, encode_basestring
+from operator import attrgetter
 from typing import *
 
 import attr
 
+from .codec import STDLIB, Codec
 
-@attr.s
+
+@attr.s(on_setattr=attr.setters.validate)
 class Localized:
     """
     Represents a localized string to be used for the body or title of an :py:class:`Alert`.
@@ -21,24 +28,30 @@ class Localized:
         ),
     )
 
+    def freeze(self) -> "FrozenLocalized":
+        return FrozenLocalized(self.key, self.args)
+
 
 MaybeLocalized = Union[Dict[str, str], Dict[str, Union[List[str], str]]]
 
 
 def maybe_localized(
-    thing: Union[str, Localized], nonloc: str, lockey: str, locarg: str
+    thing: Union[str, Localized, "FrozenLocalized"],
+    nonloc: str,
+    lockey: str,
+    locarg: str,
 ) -> MaybeLocalized:
-    if isinstance(thing, Localized):
+    if isinstance(thing, (Localized, FrozenLocalized)):
         attr.validate(thing)
         localized: Dict[str, Union[str, List[str]]] = {lockey: thing.key}
         if thing.args:
-            localized[locarg] = thing.args
+            localized[locarg] = list(thing.args)
         return localized
     else:
         return {nonloc: thing}
 
 
-@attr.s
+@attr.s(on_setattr=attr.setters.validate)
 class Alert:
     """
     Represents an alert, which can be used in :py:class:`Notification`.
@@ -88,6 +101,18 @@ class Alert:
             alert["launch-image"] = self.launch_image
         return alert
 
+    def freeze(self) -> "FrozenAlert":
+        def frozen(text):
+            return text.freeze() if isinstance(text, Localized) else text
+
+        return FrozenAlert(
+            body=frozen(self.body),
+            title=frozen(self.title),
+            subtitle=frozen(self.subtitle),
+            action_loc_key=self.action_loc_key,
+            launch_image=self.launch_image,
+        )
+
 
 @unique
 class PushType(Enum):
@@ -103,7 +128,7 @@ class PushType(Enum):
     mdm = "mdm"
 
 
-@attr.s
+@attr.s(on_setattr=attr.setters.validate)
 class Notification:
     """
     Represents a notification to send. For details on the parameters, please
@@ -173,7 +198,360 @@ class Notification:
             raw.update(self.extra)
         return raw
 
-    def encode(self) -> bytes:
-        raw = self.get_dict()
-        s = json.dumps(raw, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
-        return s.encode("utf-8")
+    def encode(self, sort_keys: bool = True, codec: Optional[Codec] = None) -> bytes:
+        """
+        Compact JSON payload, the same as encoding `get_dict()` with `json.dumps`.
+
+        Uses an encoder compiled for the shape of this notification, which
+        relies on the validation done when the models were constructed and
+        their attributes assigned. Lists and dicts changed in place, such as
+        `Localized.args` or `extra`, are not validated again. The `codec`
+        encodes values in `extra`, see `aapns.codec`.
+        """
+        return encoder_for(shape_of(self), sort_keys, codec or STDLIB)(self)
+
+    def freeze(self) -> "FrozenNotification":
+        """Immutable copy of this notification, see `FrozenNotification`"""
+        fields = attr.asdict(self, recurse=False)
+        fields["alert"] = self.alert.freeze()
+        return FrozenNotification(**fields)
+
+
+def optional_tuple(items: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    return None if items is None else tuple(items)
+
+
+@attr.s(frozen=True, slots=True)
+class FrozenLocalized:
+    """
+    Immutable and hashable :py:class:`Localized`, for :py:class:`FrozenAlert`.
+    """
+
+    key: str = attr.ib(validator=attr.validators.instance_of(str))
+    args: Optional[Tuple[str, ...]] = attr.ib(
+        default=None,
+        converter=optional_tuple,
+        validator=attr.validators.optional(
+            attr.validators.deep_iterable(
+                attr.validators.instance_of(str), attr.validators.instance_of(tuple)
+            )
+        ),
+    )
+
+
+@attr.s(frozen=True, slots=True)
+class FrozenAlert:
+    """
+    Immutable and hashable :py:class:`Alert`, for :py:class:`FrozenNotification`.
+    """
+
+    body: Union[str, FrozenLocalized] = attr.ib(
+        validator=attr.validators.instance_of((str, FrozenLocalized))
+    )
+    title: Optional[Union[str, FrozenLocalized]] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(
+            attr.validators.instance_of((str, FrozenLocalized))
+        ),
+    )
+    subtitle: Optional[Union[str, FrozenLocalized]] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(
+            attr.validators.instance_of((str, FrozenLocalized))
+        ),
+    )
+    action_loc_key: Optional[str] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    launch_image: Optional[str] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+
+    get_dict = Alert.get_dict
+
+
+@attr.s(frozen=True, slots=True)
+class FrozenNotification:
+    """
+    Immutable and hashable :py:class:`Notification`, which encodes its payload
+    only once, so it's cheap to send many times. `extra` is copied, and left
+    out of the hash, it must not be modified.
+    """
+
+    alert: FrozenAlert = attr.ib(validator=attr.validators.instance_of(FrozenAlert))
+    push_type: PushType = attr.ib(
+        default=PushType.alert, validator=attr.validators.instance_of(PushType)
+    )
+    badge: Optional[int] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(int)),
+    )
+    sound: Optional[str] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    content_available: bool = attr.ib(
+        default=False, validator=attr.validators.instance_of(bool)
+    )
+    category: Optional[str] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    thread_id: Optional[str] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    mutable_content: bool = attr.ib(
+        default=False, validator=attr.validators.instance_of(bool)
+    )
+    target_content_id: Optional[str] = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    extra: Optional[Dict[str, Any]] = attr.ib(
+        default=None,
+        hash=False,
+        converter=attr.converters.optional(dict),
+        validator=attr.validators.optional(
+            attr.validators.deep_mapping(
+                attr.validators.instance_of(str),
+                attr.validators.instance_of(object),
+                attr.validators.instance_of(dict),
+            )
+        ),
+    )
+    # by sort_keys and codec
+    _payloads: Dict[Tuple[bool, Codec], bytes] = attr.ib(
+        factory=dict, init=False, repr=False, eq=False, hash=False
+    )
+
+    get_dict = Notification.get_dict
+
+    def encode(self, sort_keys: bool = True, codec: Optional[Codec] = None) -> bytes:
+        """Like `Notification.encode`, computed once, without validating again"""
+        key = (sort_keys, codec or STDLIB)
+        if (payload := self._payloads.get(key)) is None:
+            payload = self._payloads[key] = encoder_for(shape_of(self), *key)(self)
+        return payload
+
+    @property
+    def size(self) -> int:
+        """Size of the payload as sent"""
+        return len(self.encode(sort_keys=False))
+
+
+AnyNotification = Union[Notification, FrozenNotification]
+
+ELLIPSIS = "\u2026"
+
+
+def fit(
+    notification: AnyNotification,
+    limit: int,
+    ellipsis: str = ELLIPSIS,
+    codec: Optional[Codec] = None,
+) -> AnyNotification:
+    """
+    Notification with the alert body, and then the title if needed, shortened
+    so that the payload takes at most `limit` bytes. Shortened texts end with
+    the `ellipsis`. Localized texts are left as they are.
+
+    The payload is encoded once; the longest prefix that fits is then found
+    from the escaped UTF-8 size of each character. If the texts can't absorb
+    the excess, the result is still too large, and fails the size check.
+    """
+    excess = len(notification.encode(sort_keys=False, codec=codec)) - limit
+    if excess <= 0:
+        return notification
+    texts = {}
+    for name in ("body", "title"):
+        text = getattr(notification.alert, name)
+        if excess > 0 and text and isinstance(text, str):
+            texts[name], saved = shorten(text, excess, ellipsis)
+            excess -= saved
+    alert = attr.evolve(notification.alert, **texts)
+    return attr.evolve(notification, alert=alert)  # type: ignore
+
+
+def shorten(text: str, excess: int, ellipsis: str) -> Tuple[str, int]:
+    """Longest prefix of `text` with the `ellipsis` that encodes at least
+    `excess` bytes shorter than `text`, or "", and the bytes saved
+    """
+    sizes = [0, *accumulate(map(escaped_size, text))]
+    extra = sum(map(escaped_size, ellipsis))
+    budget = sizes[-1] - excess - extra
+    if budget < 0:
+        return "", sizes[-1]
+    prefix = text[: bisect_right(sizes, budget) - 1].rstrip()
+    return prefix + ellipsis, sizes[-1] - sizes[len(prefix)] - extra
+
+
+def escaped_size(char: str) -> int:
+    """Bytes taken by the character in a JSON string, as UTF-8"""
+    if char in ESCAPE_DCT:
+        return len(ESCAPE_DCT[char])
+    code = ord(char)
+    return 1 if code < 0x80 else 2 if code < 0x800 else 3 if code < 0x10000 else 4
+
+
+Shape = Tuple[Any, ...]
+# Fragment of a payload layout: JSON text, or a function returning it
+Part = Union[str, Callable[[AnyNotification], str]]
+
+
+def text_shape(text: Any, required: bool = False) -> int:
+    """0: left out, 1: plain string, 2: localized, 3: localized with arguments"""
+    if isinstance(text, (Localized, FrozenLocalized)):
+        return 3 if text.args else 2
+    return 1 if text or required else 0
+
+
+def shape_of(notification: AnyNotification) -> Shape:
+    """Which fields of the notification end up in its payload"""
+    alert = notification.alert
+    return (
+        text_shape(alert.title),
+        text_shape(alert.subtitle),
+        text_shape(alert.body, required=True),
+        bool(alert.action_loc_key),
+        bool(alert.launch_image),
+        bool(notification.badge),
+        bool(notification.sound),
+        bool(notification.content_available),
+        bool(notification.category),
+        bool(notification.thread_id),
+        bool(notification.mutable_content),
+        bool(notification.target_content_id),
+        tuple(notification.extra) if notification.extra else (),
+    )
+
+
+@lru_cache(256)
+def encoder_for(
+    shape: Shape, sort_keys: bool, codec: Codec
+) -> Callable[[AnyNotification], bytes]:
+    """Compile an encoder for notifications of the given shape
+
+    The encoder fills the values into a template of the payload, so that
+    only the values are escaped on each call.
+    """
+    parts: List[Part] = []
+    flatten(layout(shape, sort_keys, codec), sort_keys, parts)
+    template = "".join(
+        p.replace("%", "%%") if isinstance(p, str) else "%s" for p in parts
+    )
+    getters = [p for p in parts if not isinstance(p, str)]
+
+    def encode(notification: AnyNotification) -> bytes:
+        return (template % tuple([get(notification) for get in getters])).encode()
+
+    return encode
+
+
+def layout(shape: Shape, sort_keys: bool, codec: Codec) -> Dict[str, Any]:
+    """Payload dictionary like `Notification.get_dict`, with `Part` values"""
+    (
+        title,
+        subtitle,
+        body,
+        action_loc_key,
+        launch_image,
+        badge,
+        sound,
+        content_available,
+        category,
+        thread_id,
+        mutable_content,
+        target_content_id,
+        extra,
+    ) = shape
+    alert: Dict[str, Any] = {}
+    add_text(alert, title, "title", "title", "title-loc-key", "title-loc-args")
+    add_text(
+        alert, subtitle, "subtitle", "subtitle", "subtitle-loc-key", "subtitle-loc-args"
+    )
+    add_text(alert, body, "body", "body", "loc-key", "loc-args")
+    if action_loc_key:
+        alert["action-loc-key"] = string("alert.action_loc_key")
+    if launch_image:
+        alert["launch-image"] = string("alert.launch_image")
+    apns: Dict[str, Any] = {"alert": alert}
+    if badge:
+        apns["badge"] = number("badge")
+    if sound:
+        apns["sound"] = string("sound")
+    if content_available:
+        apns["content-available"] = "1"
+    if category:
+        apns["category"] = string("category")
+    if thread_id:
+        apns["thread-id"] = string("thread_id")
+    if mutable_content:
+        apns["mutable-content"] = "1"
+    if target_content_id:
+        apns["target-content-id"] = string("target_content_id")
+    raw: Dict[str, Any] = {"aps": apns}
+    for key in extra:
+        raw[key] = extra_value(key, sort_keys, codec)
+    return raw
+
+
+def add_text(
+    alert: Dict[str, Any], shape: int, name: str, nonloc: str, lockey: str, locarg: str
+):
+    if shape == 1:
+        alert[nonloc] = string(f"alert.{name}")
+    elif shape:
+        alert[lockey] = string(f"alert.{name}.key")
+        if shape == 3:
+            alert[locarg] = strings(f"alert.{name}.args")
+
+
+def string(path: str) -> Part:
+    get = attrgetter(path)
+    return lambda notification: encode_basestring(get(notification))
+
+
+def strings(path: str) -> Part:
+    get = attrgetter(path)
+    return lambda notification: "[%s]" % ",".join(
+        map(encode_basestring, get(notification))
+    )
+
+
+def number(path: str) -> Part:
+    get = attrgetter(path)
+
+    def encode(notification: AnyNotification) -> str:
+        value = get(notification)
+        return int.__repr__(value) if type(value) is int else json.dumps(value)
+
+    return encode
+
+
+def extra_value(key: str, sort_keys: bool, codec: Codec) -> Part:
+    def encode(notification: AnyNotification) -> str:
+        value = notification.extra[key]  # type: ignore
+        if type(value) is str:
+            return encode_basestring(value)
+        if type(value) is int:
+            return int.__repr__(value)
+        return codec.dumps(value, sort_keys).decode()
+
+    return encode
+
+
+def flatten(node: Any, sort_keys: bool, parts: List[Part]):
+    """Serialise a layout into `parts`, the way `json.dumps` would"""
+    if not isinstance(node, dict):
+        parts.append(node)
+        return
+    parts.append("{")
+    for i, (key, value) in enumerate(
+        sorted(node.items()) if sort_keys else node.items()
+    ):
+        parts.append(("," if i else "") + encode_basestring(key) + ":")
+        flatten(value, sort_keys, parts)
+    parts.append("}")
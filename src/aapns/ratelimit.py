@@ -0,0 +1,161 @@
+"""Client side rate limiting in front of a connection pool"""
+from __future__ import annotations
+
+from asyncio import CancelledError, sleep
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Dict, List, Optional
+
+from .connection import Request, Response
+from .errors import RateLimited, Timeout
+from .pool import PoolProtocol
+
+# Time for a tightened bucket to recover to its configured rate, in seconds
+RECOVERY_TIME = 60
+# Tightened rate never drops below this fraction of the configured rate
+MIN_RATE_FRACTION = 1 / 64
+
+
+@dataclass(frozen=True)
+class Limit:
+    """Sustained `rate` in requests per second, allowing bursts of `burst`"""
+
+    rate: float
+    burst: Optional[float] = None
+
+    def __post_init__(self):
+        if not self.rate > 0:
+            raise ValueError("Rate limit must be strictly positive")
+        if self.burst is not None and not self.burst > 0:
+            raise ValueError("Rate limit burst must be strictly positive")
+
+    def bucket(self, now: float) -> TokenBucket:
+        burst = self.burst if self.burst is not None else max(self.rate, 1)
+        return TokenBucket(self.rate, self.rate, burst, burst, now)
+
+
+@dataclass
+class TokenBucket:
+    """Token bucket where requests reserve tokens ahead of time
+
+    The token count can go negative, which makes requests that wait on the
+    same bucket go out in order without waking each other up.
+    """
+
+    rate: float
+    max_rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        if self.rate < self.max_rate:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * elapsed / RECOVERY_TIME
+            )
+
+    def wait_time(self) -> float:
+        """Time until a token is available, call `.refill()` first"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def tighten(self):
+        """Halve the rate, e.g. because the server says we are too fast"""
+        self.rate = max(self.rate / 2, self.max_rate * MIN_RATE_FRACTION)
+        self.tokens = min(self.tokens, 0)
+
+
+@dataclass(eq=False)
+class RateLimitedPool:
+    """Connection pool wrapper that limits the request rate
+
+    Requests are limited globally, per `apns-topic` header value and per device
+    token (request path). At most `max_devices` per device buckets are kept,
+    the least recently used ones are dropped.
+
+    If `wait` is set, requests that are over the limit are delayed, unless that
+    would take them past their deadline, in which case `Timeout` is raised.
+    Otherwise, such requests are rejected with `RateLimited`.
+
+    `TooManyRequests` responses halve the rate of the device bucket, or of the
+    topic or global bucket if there's no device limit. The rate recovers to the
+    configured one over `RECOVERY_TIME`.
+
+    Example use:
+
+        pool = RateLimitedPool(await Pool.create(...), device=Limit(1, 5))
+        client = APNS(pool)
+    """
+
+    pool: PoolProtocol
+    total: Optional[Limit] = None
+    topic: Optional[Limit] = None
+    device: Optional[Limit] = None
+    wait: bool = True
+    max_devices: int = 100_000
+    total_bucket: Optional[TokenBucket] = field(init=False)
+    topic_buckets: Dict[Optional[str], TokenBucket] = field(default_factory=dict)
+    device_buckets: OrderedDict[str, TokenBucket] = field(default_factory=OrderedDict)
+    limited: int = 0
+    tightened: int = 0
+
+    def __post_init__(self):
+        self.total_bucket = self.total.bucket(monotonic()) if self.total else None
+
+    async def post(self, request: Request) -> Response:
+        """Post the `request` on the pool, once the rate limits allow"""
+        buckets = self.buckets_for(request)
+        now = monotonic()
+        for bucket in buckets:
+            bucket.refill(now)
+        delay = max((b.wait_time() for b in buckets), default=0)
+        if delay:
+            self.limited += 1
+            if not self.wait:
+                raise RateLimited(f"Request rate limited for {delay:.3f}s")
+            if request.get_time_left_or_fail() < delay:
+                raise Timeout("Request would time out awaiting rate limit")
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if delay:
+            try:
+                await sleep(delay)
+            except CancelledError:
+                # give back the reservation, or it would eat capacity for good
+                for bucket in buckets:
+                    bucket.tokens += 1
+                raise
+
+        response = await self.pool.post(request)
+        if response.reason == "TooManyRequests" and buckets:
+            self.tightened += 1
+            buckets[-1].tighten()
+        return response
+
+    async def close(self):
+        await self.pool.close()
+
+    def buckets_for(self, request: Request) -> List[TokenBucket]:
+        """Buckets applicable to the request, from the widest to the narrowest"""
+        buckets = [self.total_bucket] if self.total_bucket else []
+        if not self.topic and not self.device:
+            return buckets
+        header = dict(request.header)
+        if self.topic:
+            topic = header.get("apns-topic")
+            if not (bucket := self.topic_buckets.get(topic)):
+                bucket = self.topic_buckets[topic] = self.topic.bucket(monotonic())
+            buckets.append(bucket)
+        if self.device:
+            path = header[":path"]
+            if bucket := self.device_buckets.get(path):
+                self.device_buckets.move_to_end(path)
+            else:
+                bucket = self.device_buckets[path] = self.device.bucket(monotonic())
+                while len(self.device_buckets) > self.max_devices:
+                    self.device_buckets.popitem(last=False)
+            buckets.append(bucket)
+        return buckets
@@ -0,0 +1,258 @@
+"""Sender that spreads notifications over several worker processes
+
+One event loop is bound to one core, and HTTP/2 framing and JSON encoding
+saturate it well before Apple's limits. `ShardedSender` runs a worker process
+per core, each with its own client and connection pool, and dispatches
+device tokens to them by hash, in batches over pipes. Results come back per
+batch and are aggregated in the parent.
+"""
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import count
+from multiprocessing.connection import Connection, wait
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+from zlib import crc32
+
+from .api import APNS, PreparedNotification, Result, Target
+from .errors import APNSError, Closed
+
+Outcome = Union[Result, APNSError]
+
+
+@dataclass(eq=False)
+class ShardedSender:
+    """Send notifications from `len(pipes)` worker processes
+
+    Tokens go out in batches of `batch_size` per worker, with at most `window`
+    batches in progress per worker. A given token always goes to the same
+    worker. `stats` counts the outcomes so far, per `Result.reason` or error
+    class name.
+
+    Example use:
+
+        with ShardedSender.create(Server.production("/etc/apns.pem")) as sender:
+            prepared = PreparedNotification.new(notification)
+            for token, outcome in sender.post_many(tokens, prepared):
+                ...
+    """
+
+    processes: List[multiprocessing.process.BaseProcess]
+    pipes: List[Connection]
+    batch_size: int = 256
+    window: int = 4
+    stats: Counter[str] = field(default_factory=Counter)
+    batch_ids: Iterator[int] = field(default_factory=count)
+
+    @classmethod
+    def create(
+        cls,
+        target: Target,
+        workers: Optional[int] = None,
+        *,
+        batch_size: int = 256,
+        window: int = 4,
+        start_method: Optional[str] = None,
+    ) -> ShardedSender:
+        """Start `workers` processes, one per CPU by default, each connecting
+        to `target`, which must be picklable"""
+        workers = workers or os.cpu_count() or 1
+        if batch_size < 1 or window < 1:
+            raise ValueError("Batch size and window must be strictly positive")
+        context: Any = multiprocessing.get_context(start_method)
+        processes, pipes = [], []
+        for i in range(workers):
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=work, args=(target, child), name=f"aapns-{i}", daemon=True
+            )
+            process.start()
+            child.close()
+            processes.append(process)
+            pipes.append(parent)
+        self = cls(processes, pipes, batch_size, window)
+        try:
+            for pipe in pipes:
+                if (error := receive(pipe)) is not None:
+                    raise error
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def shard(self, token: str) -> int:
+        return crc32(token.encode()) % len(self.pipes)
+
+    def post_many(
+        self,
+        tokens: Iterable[str],
+        prepared: PreparedNotification,
+        *,
+        timeout: Optional[float] = 10,
+        deadline: Optional[float] = None,
+    ) -> Iterator[Tuple[str, Outcome]]:
+        """Like `APNS.post_many`, yields `(token, outcome)` in completion order
+
+        The outcome is a `Result`, or the `APNSError` that prevented getting a
+        response. Other exceptions are raised.
+        """
+        options = dict(timeout=timeout, deadline=deadline)
+        buffers: List[List[str]] = [[] for pipe in self.pipes]
+        inflight = [0] * len(self.pipes)
+        batches: Dict[int, List[str]] = {}
+
+        def flush(i: int) -> Iterator[Tuple[str, Outcome]]:
+            while inflight[i] >= self.window:
+                yield from collect(None)
+            batch_id = next(self.batch_ids)
+            self.pipes[i].send((batch_id, prepared, buffers[i], options))
+            batches[batch_id] = buffers[i]
+            buffers[i] = []
+            inflight[i] += 1
+
+        def collect(timeout: Optional[float]) -> Iterator[Tuple[str, Outcome]]:
+            busy = [pipe for pipe, n in zip(self.pipes, inflight) if n]
+            for ready in wait(busy, timeout):
+                pipe = cast(Connection, ready)
+                batch_id, outcomes = receive(pipe)
+                inflight[self.pipes.index(pipe)] -= 1
+                for token, outcome in zip(batches.pop(batch_id), outcomes):
+                    if isinstance(outcome, tuple):
+                        outcome = Result._make(outcome)
+                        self.stats[outcome.reason or "Success"] += 1
+                    else:
+                        self.stats[type(outcome).__name__] += 1
+                    yield token, outcome
+
+        for token in tokens:
+            i = self.shard(token)
+            buffers[i].append(token)
+            if len(buffers[i]) >= self.batch_size:
+                yield from flush(i)
+                yield from collect(0)
+        for i, buffer in enumerate(buffers):
+            if buffer:
+                yield from flush(i)
+        while batches:
+            yield from collect(None)
+
+    def close(self):
+        """Let the workers finish and wait for them to exit"""
+        for pipe in self.pipes:
+            with suppress(OSError):
+                pipe.send(None)
+        for process in self.processes:
+            process.join()
+        for pipe in self.pipes:
+            pipe.close()
+
+
+def receive(pipe: Connection) -> Any:
+    try:
+        message = pipe.recv()
+    except EOFError:
+        raise Closed("Worker process exited")
+    if isinstance(message, BaseException):
+        raise message
+    return message
+
+
+def work(target: Target, pipe: Connection):
+    """Worker process entry point"""
+    asyncio.run(serve(target, pipe))
+
+
+async def serve(target: Target, pipe: Connection):
+    try:
+        client = await target.create_client()
+        if not isinstance(client, APNS):
+            raise TypeError(f"{type(client).__name__} can't post notifications")
+    except Exception as e:
+        pipe.send(e)
+        return
+    pipe.send(None)
+
+    loop = asyncio.get_running_loop()
+    # Sends block while the parent is slow to read, keep them off the loop
+    # thread, and in one thread, as they must not interleave
+    writer = ThreadPoolExecutor(1, thread_name_prefix="aapns-writer")
+
+    async def send(message: Any):
+        await loop.run_in_executor(writer, pipe.send, message)
+
+    tasks = set()
+    try:
+        while (message := await loop.run_in_executor(None, pipe.recv)) is not None:
+            task = asyncio.create_task(run_batch(client, send, *message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await client.close()
+        writer.shutdown()
+
+
+async def run_batch(
+    client: APNS,
+    send: Callable[[Any], Awaitable],
+    batch_id: int,
+    prepared: PreparedNotification,
+    tokens: List[str],
+    options: dict,
+):
+    """Post a batch and send back the outcomes, in the order of `tokens`"""
+    outcomes: List[Any] = [None] * len(tokens)
+    remaining = len(tokens)
+    done = asyncio.get_running_loop().create_future()
+
+    def callback(i: int, token: str, outcome: Outcome):
+        nonlocal remaining
+        outcomes[i] = tuple(outcome) if isinstance(outcome, Result) else outcome
+        remaining -= 1
+        if not remaining and not done.done():
+            done.set_result(None)
+
+    try:
+        if hasattr(client.pool, "submit"):
+            for i, token in enumerate(tokens):
+                client.submit(token, prepared, partial(callback, i), **options)
+        else:
+            results = await asyncio.gather(
+                *(client.post_prepared(t, prepared, **options) for t in tokens),
+                return_exceptions=True,
+            )
+            for i, outcome in enumerate(results):
+                if not isinstance(outcome, (Result, APNSError)):
+                    raise outcome
+                callback(i, tokens[i], outcome)
+        if remaining:
+            await done
+        await send((batch_id, outcomes))
+    except Exception as e:
+        await send(e)
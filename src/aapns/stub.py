@@ -0,0 +1,351 @@
+"""In-process APNs stand-in, for tests and benchmarks
+
+`StubServer` speaks HTTP/2 over TLS on a loopback port with h2, like the
+client, so the whole stack can be exercised without Apple's servers or a Go
+toolchain:
+
+    async with StubServer(certfile, keyfile, latency=lambda rng: 0.01) as stub:
+        client = await Server(cert, "localhost", stub.port, ca_file=certfile).create_client()
+        ...
+
+Each response is delayed by `latency(rng)` seconds, and fails with a reason
+drawn from the `reasons` mix. The `MAX_CONCURRENT_STREAMS` and window settings
+are configurable, and connections can be made to end with GOAWAY or to drop
+after some requests. Pass a `seed` for repeatable runs.
+
+Faults can also be injected while the server runs, by changing `latency`,
+`reasons`, `reset_streams`, `window_update_delay` or `handshake_failures`, or
+by calling `go_away()`; see `aapns.faults` for scripted scenarios.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+import ssl
+import uuid
+from asyncio import CancelledError
+from collections import Counter
+from contextlib import suppress
+from dataclasses import dataclass, field
+from logging import getLogger
+from time import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.exceptions
+import h2.settings
+
+from . import loopback
+
+logger = getLogger(__package__)
+
+# Error response status by reason, others are 400 Bad Request
+STATUS: Dict[str, int] = {
+    "BadCertificate": 403,
+    "BadCertificateEnvironment": 403,
+    "ExpiredProviderToken": 403,
+    "Forbidden": 403,
+    "InvalidProviderToken": 403,
+    "MissingProviderToken": 403,
+    "BadPath": 404,
+    "MethodNotAllowed": 405,
+    "Unregistered": 410,
+    "PayloadTooLarge": 413,
+    "TooManyProviderTokenUpdates": 429,
+    "TooManyRequests": 429,
+    "InternalServerError": 500,
+    "ServiceUnavailable": 503,
+    "Shutdown": 503,
+}
+DEFAULT_WINDOW_SIZE = 65535
+
+
+def no_latency(rng: random.Random) -> float:
+    return 0.0
+
+
+@dataclass(eq=False)
+class StubServer:
+    """APNs stand-in on a TLS socket, see the module documentation
+
+    Use as an async context manager, or call `start` and `close`. With the
+    default `port` 0 a free port is picked, `port` is set once started. Without
+    a `certfile`, it doesn't listen, connections are made with `pipe()` only.
+
+    * `reasons`: error reason by probability, the rest succeed
+    * `connection_window_size`: grown from the 65535 bytes HTTP/2 starts with
+    * `goaway_after`: responses on a connection, then GOAWAY and close it
+    * `drop_after`: requests on a connection, then abort it without a word
+    * `shutdown_after`: responses in total, then GOAWAY and stop listening
+    * `reset_streams`: probability of resetting a request's stream instead of
+      responding
+    * `window_update_delay`: seconds before received data is credited back to
+      the client's flow control windows
+    * `handshake_failures`: count of upcoming TLS handshakes to fail
+    """
+
+    certfile: Optional[str] = None
+    keyfile: Optional[str] = None
+    host: str = "localhost"
+    port: int = 0
+    latency: Callable[[random.Random], float] = no_latency
+    reasons: Dict[str, float] = field(default_factory=dict)
+    seed: Optional[int] = None
+    max_concurrent_streams: int = 1000
+    initial_window_size: int = DEFAULT_WINDOW_SIZE
+    connection_window_size: int = DEFAULT_WINDOW_SIZE
+    goaway_after: Optional[int] = None
+    goaway_reason: Optional[str] = None
+    drop_after: Optional[int] = None
+    shutdown_after: Optional[int] = None
+    reset_streams: float = 0.0
+    window_update_delay: float = 0.0
+    handshake_failures: int = 0
+    requests: int = 0
+    # by reason, None if OK, "StreamReset" if reset
+    responses: Counter = field(default_factory=Counter)
+    connections: Set[StubConnection] = field(default_factory=set)
+    accepting: Set[asyncio.Task] = field(default_factory=set)  # pipe connections
+    handlers: Set[asyncio.Task] = field(default_factory=set)
+    rng: random.Random = field(init=False)
+    listener: Optional[asyncio.AbstractServer] = None
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    @property
+    def origin(self) -> str:
+        return f"https://{self.host}:{self.port}"
+
+    def create_ssl_context(self) -> ssl.SSLContext:
+        assert self.certfile
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.certfile, self.keyfile)
+        context.set_alpn_protocols(["h2"])
+        context.sni_callback = self.handshake
+        return context
+
+    def handshake(self, socket: ssl.SSLObject, name: str, context: ssl.SSLContext):
+        if self.handshake_failures > 0:
+            self.handshake_failures -= 1
+            return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
+        return None
+
+    async def start(self):
+        if not self.certfile:
+            return
+        self.listener = await asyncio.start_server(
+            self.accept, self.host, self.port, ssl=self.create_ssl_context()
+        )
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """Stop listening and abort all connections"""
+        self.stop_listening()
+        for connection in list(self.connections):
+            connection.abort()
+        while tasks := self.handlers | self.accepting:
+            await asyncio.wait(tasks)
+
+    async def __aenter__(self) -> StubServer:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def stop_listening(self):
+        if self.listener:
+            self.listener.close()
+
+    async def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = StubConnection(self, reader, writer)
+        task = asyncio.current_task()
+        assert task
+        self.connections.add(connection)
+        self.handlers.add(task)
+        try:
+            await connection.serve()
+        finally:
+            self.connections.discard(connection)
+            self.handlers.discard(task)
+
+    def pipe(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Client end of a connection in memory, without TLS, see `loopback.pipe`
+
+        Doesn't need the server to be started.
+        """
+        client, server = loopback.pipe()
+        task = asyncio.create_task(self.accept(*server))
+        self.accepting.add(task)
+        task.add_done_callback(self.accepting.discard)
+        return client
+
+    def pick_reason(self) -> Optional[str]:
+        """Error reason from the mix, or None for success"""
+        draw = self.rng.random()
+        for reason, probability in self.reasons.items():
+            if draw < probability:
+                return reason
+            draw -= probability
+        return None
+
+    def responded(self, reason: Optional[str]):
+        self.responses[reason] += 1
+        if sum(self.responses.values()) == self.shutdown_after:
+            logger.info("Stub server shutting down")
+            self.stop_listening()
+            self.go_away()
+
+    def go_away(self):
+        """GOAWAY on all connections, see `StubConnection.go_away`"""
+        for connection in list(self.connections):
+            connection.go_away()
+
+
+@dataclass(eq=False)
+class StubConnection:
+    server: StubServer
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    protocol: h2.connection.H2Connection = field(init=False)
+    # by stream ID, response timers and APNS IDs of requests awaiting response
+    pending: Dict[int, asyncio.TimerHandle] = field(default_factory=dict)
+    apns_ids: Dict[int, str] = field(default_factory=dict)
+    requests: int = 0
+    responses: int = 0
+    closing: bool = False
+
+    def __post_init__(self):
+        server = self.server
+        self.protocol = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        codes = h2.settings.SettingCodes
+        self.protocol.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={
+                codes.MAX_CONCURRENT_STREAMS: server.max_concurrent_streams,
+                codes.INITIAL_WINDOW_SIZE: server.initial_window_size,
+            },
+        )
+
+    async def serve(self):
+        self.protocol.initiate_connection()
+        if (grow := self.server.connection_window_size - DEFAULT_WINDOW_SIZE) > 0:
+            self.protocol.increment_flow_control_window(grow)
+        self.flush()
+        try:
+            while not self.closing and (data := await self.reader.read(2 ** 16)):
+                for event in self.protocol.receive_data(data):
+                    self.handle(event)
+                self.flush()
+                # Stop reading requests while the client doesn't read responses
+                await self.writer.drain()
+        except (ConnectionError, ssl.SSLError, h2.exceptions.ProtocolError) as e:
+            logger.debug("Stub connection failed: %r", e)
+        except CancelledError:
+            pass
+        finally:
+            for timer in self.pending.values():
+                timer.cancel()
+            self.writer.close()
+            with suppress(ConnectionError, ssl.SSLError):
+                await self.writer.wait_closed()
+
+    def handle(self, event: h2.events.Event):
+        if isinstance(event, h2.events.RequestReceived):
+            apns_id = next((v for k, v in event.headers if k == "apns-id"), None)
+            self.apns_ids[event.stream_id] = str(apns_id or uuid.uuid4())
+        elif isinstance(event, h2.events.DataReceived):
+            if self.server.window_update_delay:
+                asyncio.get_running_loop().call_later(
+                    self.server.window_update_delay,
+                    self.acknowledge,
+                    event.flow_controlled_length,
+                    event.stream_id,
+                )
+            else:
+                self.protocol.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+        elif isinstance(event, h2.events.StreamEnded):
+            self.received(event.stream_id)
+        elif isinstance(event, h2.events.StreamReset):
+            self.apns_ids.pop(event.stream_id, None)
+            if timer := self.pending.pop(event.stream_id, None):
+                timer.cancel()
+
+    def received(self, stream_id: int):
+        server = self.server
+        self.requests += 1
+        server.requests += 1
+        if self.requests == server.drop_after:
+            self.abort()
+            return
+        if server.reset_streams and server.rng.random() < server.reset_streams:
+            self.apns_ids.pop(stream_id)
+            self.protocol.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+            server.responded("StreamReset")
+            return
+        self.pending[stream_id] = asyncio.get_running_loop().call_later(
+            server.latency(server.rng), self.respond, stream_id
+        )
+
+    def respond(self, stream_id: int):
+        del self.pending[stream_id]
+        if self.closing:
+            return
+        header = [("apns-id", self.apns_ids.pop(stream_id))]
+        reason = self.server.pick_reason()
+        try:
+            if reason:
+                data = {"reason": reason}
+                if reason == "Unregistered":
+                    data["timestamp"] = int(time() * 1000)  # type: ignore
+                self.protocol.send_headers(
+                    stream_id, [(":status", str(STATUS.get(reason, 400))), *header]
+                )
+                self.protocol.send_data(
+                    stream_id, json.dumps(data).encode(), end_stream=True
+                )
+            else:
+                self.protocol.send_headers(
+                    stream_id, [(":status", "200"), *header], end_stream=True
+                )
+        except h2.exceptions.StreamClosedError:
+            return
+        self.flush()
+        self.responses += 1
+        if self.responses == self.server.goaway_after:
+            self.go_away()
+        self.server.responded(reason)
+
+    def acknowledge(self, size: int, stream_id: int):
+        if not self.closing:
+            self.protocol.acknowledge_received_data(size, stream_id)
+            self.flush()
+
+    def go_away(self):
+        """Send GOAWAY and close, requests awaiting response are dropped"""
+        if self.closing:
+            return
+        reason = self.server.goaway_reason
+        self.protocol.close_connection(
+            additional_data=json.dumps({"reason": reason}).encode() if reason else None
+        )
+        self.flush()
+        self.closing = True
+        self.writer.close()
+
+    def abort(self):
+        self.closing = True
+        self.writer.transport.abort()
+
+    def flush(self):
+        if data := self.protocol.data_to_send():
+            self.writer.write(data)
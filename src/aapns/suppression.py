@@ -0,0 +1,235 @@
+"""Local record of device tokens the server reported as invalid
+
+When the server responds `Unregistered` or `BadDeviceToken`, sending to the
+same token again only wastes streams and risks throttling. A suppression store
+remembers such tokens, so that `APNS` can reject them without a request.
+
+Tokens are kept as binary, 32 bytes for the usual 64 hex digit token.
+"""
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+from dataclasses import dataclass, field
+from hashlib import blake2b
+from time import time
+from typing import Dict, Optional, Protocol, Tuple
+
+
+class SuppressionStore(Protocol):
+    def __contains__(self, token: str) -> bool:
+        ...
+
+    def add(self, token: str, since: Optional[float] = None):
+        ...
+
+    def discard(self, token: str, registered_at: Optional[float] = None):
+        ...
+
+
+def token_key(token: str) -> bytes:
+    """Compact binary key for a device token"""
+    try:
+        return bytes.fromhex(token)
+    except ValueError:
+        return token.encode("utf-8")
+
+
+@dataclass(eq=False)
+class MemorySuppression:
+    """In-memory suppression store
+
+    Tokens are suppressed for `ttl` seconds from when they were last added, or
+    forever if `ttl` is None. `since`, when the token was known to be invalid,
+    only decides whether a later registration releases it, see `discard`.
+    """
+
+    ttl: Optional[float] = None
+    # by token, (since, added)
+    entries: Dict[bytes, Tuple[float, float]] = field(default_factory=dict)
+
+    def __contains__(self, token: str) -> bool:
+        key = token_key(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if self.ttl is not None and entry[1] + self.ttl < time():
+            del self.entries[key]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, token: str, since: Optional[float] = None):
+        """Suppress the token, `since` is when it was known to be invalid"""
+        key = token_key(token)
+        now = time()
+        since = now if since is None else since
+        if entry := self.entries.get(key):
+            since = max(since, entry[0])
+        self.entries[key] = (since, now)
+
+    def discard(self, token: str, registered_at: Optional[float] = None):
+        """
+        Stop suppressing the token, for example because the device has
+        registered it again. If `registered_at` is given, the token is only
+        released if it was registered after it was reported invalid.
+        """
+        key = token_key(token)
+        entry = self.entries.get(key)
+        if entry is not None and (registered_at is None or registered_at > entry[0]):
+            del self.entries[key]
+
+    def purge(self):
+        """Drop expired entries"""
+        if self.ttl is not None:
+            cutoff = time() - self.ttl
+            self.entries = {k: v for k, v in self.entries.items() if v[1] >= cutoff}
+
+
+@dataclass(eq=False)
+class BloomFilter:
+    """Probabilistic set without false negatives, used as a fast front"""
+
+    size: int = 2 ** 23  # bits, 1MB
+    hashes: int = 7
+    bits: bytearray = field(init=False)
+
+    def __post_init__(self):
+        self.bits = bytearray(self.size // 8)
+
+    def positions(self, key: bytes):
+        digest = blake2b(key, digest_size=4 * self.hashes).digest()
+        for i in range(0, len(digest), 4):
+            yield int.from_bytes(digest[i : i + 4], "little") % self.size
+
+    def add(self, key: bytes):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+@dataclass(eq=False)
+class SQLiteSuppression:
+    """Persistent suppression store backed by an SQLite database
+
+    A Bloom filter in front of the database answers most lookups for valid
+    tokens without a query. Queries are synchronous, but they are short.
+
+    Added tokens are buffered in memory, and written in one transaction once
+    `batch_size` are buffered, `flush_interval` seconds after the first one
+    if an event loop is running, or on `flush()` and `close()`.
+    """
+
+    path: str
+    ttl: Optional[float] = None
+    batch_size: int = 100
+    flush_interval: float = 1.0
+    db: sqlite3.Connection = field(init=False)
+    front: BloomFilter = field(default_factory=BloomFilter)
+    # by token, (since, added), see `MemorySuppression`
+    buffer: Dict[bytes, Tuple[float, float]] = field(default_factory=dict)
+    flush_timer: Optional[asyncio.TimerHandle] = None
+
+    def __post_init__(self):
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS suppressed "
+            "(token BLOB PRIMARY KEY, since REAL NOT NULL, added REAL NOT NULL) "
+            "WITHOUT ROWID"
+        )
+        for (key,) in self.db.execute("SELECT token FROM suppressed"):
+            self.front.add(key)
+
+    def __contains__(self, token: str) -> bool:
+        key = token_key(token)
+        if key not in self.front:
+            return False
+        if key in self.buffer:
+            added = self.buffer[key][1]
+        else:
+            row = self.db.execute(
+                "SELECT added FROM suppressed WHERE token = ?", (key,)
+            ).fetchone()
+            if not row:
+                return False
+            added = row[0]
+        if self.ttl is not None and added + self.ttl < time():
+            self.buffer.pop(key, None)
+            self.db.execute("DELETE FROM suppressed WHERE token = ?", (key,))
+            return False
+        return True
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute("SELECT count(*) FROM suppressed").fetchone()[0]
+
+    def add(self, token: str, since: Optional[float] = None):
+        """Suppress the token, `since` is when it was known to be invalid"""
+        key = token_key(token)
+        now = time()
+        since = now if since is None else since
+        if entry := self.buffer.get(key):
+            since = max(since, entry[0])
+        self.buffer[key] = (since, now)
+        self.front.add(key)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif not self.flush_timer:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self.flush_timer = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write the buffered tokens"""
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if not self.buffer:
+            return
+        rows = [(key, since, added) for key, (since, added) in self.buffer.items()]
+        self.buffer = {}
+        # rather than an upsert, which needs SQLite 3.24
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO suppressed VALUES (?, ?, ?)", rows
+            )
+            self.db.executemany(
+                "UPDATE suppressed SET since = max(since, ?), added = ? WHERE token = ?",
+                [(since, added, key) for key, since, added in rows],
+            )
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def discard(self, token: str, registered_at: Optional[float] = None):
+        """See `MemorySuppression.discard`"""
+        self.flush()
+        if registered_at is None:
+            self.db.execute(
+                "DELETE FROM suppressed WHERE token = ?", (token_key(token),)
+            )
+        else:
+            self.db.execute(
+                "DELETE FROM suppressed WHERE token = ? AND since < ?",
+                (token_key(token), registered_at),
+            )
+
+    def purge(self):
+        """Drop expired entries"""
+        if self.ttl is not None:
+            self.flush()
+            self.db.execute(
+                "DELETE FROM suppressed WHERE added < ?", (time() - self.ttl,)
+            )
+
+    def close(self):
+        self.flush()
+        self.db.close()
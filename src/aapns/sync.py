@@ -0,0 +1,165 @@
+"""Synchronous client for threaded code, such as WSGI or Celery workers
+
+The client owns an event loop running in a background thread, with one long
+lived asynchronous client, so that connections are reused across sends. Every
+method can be called from any thread and returns a `concurrent.futures.Future`.
+
+Submissions are queued and handed to the loop in batches: only a submission
+to an empty queue wakes the loop up, the rest ride along.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Optional, Set, Tuple
+
+from . import models
+from .api import APNS, APNSBaseClient, PreparedNotification, Target
+from .errors import Closed
+
+Call = Tuple[Future, Callable[..., Awaitable], tuple, dict]
+
+
+@dataclass(eq=False)
+class SyncClient:
+    """Thread-safe synchronous facade over the client created by `target`
+
+    Example use:
+
+        client = SyncClient.create(Server.production("/etc/apns.pem"))
+        try:
+            apns_id = client.send_notification(token, notification).result()
+        finally:
+            client.close()
+    """
+
+    loop: asyncio.AbstractEventLoop
+    thread: threading.Thread
+    client: Optional[APNSBaseClient] = None
+    closing: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    inbox: Deque[Call] = field(default_factory=deque)
+    running: Set[asyncio.Task] = field(default_factory=set)
+    wakeups: int = 0
+
+    @classmethod
+    def create(cls, target: Target) -> SyncClient:
+        """Start the loop thread and connect, blocks until the client is ready"""
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="aapns", daemon=True)
+        thread.start()
+        self = cls(loop, thread)
+        try:
+            self.client = asyncio.run_coroutine_threadsafe(
+                target.create_client(), loop
+            ).result()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, function: Callable[..., Awaitable], *args, **kwargs) -> Future:
+        """Run `function(*args, **kwargs)` on the loop thread"""
+        future: Future = Future()
+        with self.lock:
+            if self.closing:
+                raise Closed("Client closed")
+            wake = not self.inbox
+            self.inbox.append((future, function, args, kwargs))
+        if wake:
+            self.wakeups += 1
+            self.loop.call_soon_threadsafe(self.flush)
+        return future
+
+    def send_notification(
+        self, token: str, notification: models.AnyNotification, **kwargs: Any
+    ) -> Future:
+        """See `APNSBaseClient.send_notification`, resolves to the APNS ID"""
+        assert self.client
+        return self.call(self.client.send_notification, token, notification, **kwargs)
+
+    def send_prepared(
+        self, token: str, prepared: PreparedNotification, **kwargs: Any
+    ) -> Future:
+        """See `APNS.send_prepared`, resolves to the APNS ID"""
+        return self.call(self.apns.send_prepared, token, prepared, **kwargs)
+
+    def post_notification(
+        self, token: str, notification: models.AnyNotification, **kwargs: Any
+    ) -> Future:
+        """See `APNS.post_notification`, resolves to a `Result`"""
+        return self.call(self.apns.post_notification, token, notification, **kwargs)
+
+    def post_prepared(
+        self, token: str, prepared: PreparedNotification, **kwargs: Any
+    ) -> Future:
+        """See `APNS.post_prepared`, resolves to a `Result`"""
+        return self.call(self.apns.post_prepared, token, prepared, **kwargs)
+
+    @property
+    def apns(self) -> APNS:
+        if not isinstance(self.client, APNS):
+            raise TypeError(f"{type(self.client).__name__} can't post notifications")
+        return self.client
+
+    def close(self):
+        """Finish pending sends, close the client and stop the loop thread"""
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def flush(self):
+        """Start everything submitted so far, on the loop thread"""
+        with self.lock:
+            calls, self.inbox = self.inbox, deque()
+        for future, function, args, kwargs in calls:
+            if future.set_running_or_notify_cancel():
+                try:
+                    coroutine = function(*args, **kwargs)
+                except Exception as e:
+                    # Don't lose the rest of the batch
+                    future.set_exception(e)
+                    continue
+                task = self.loop.create_task(run(future, coroutine))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+    async def shutdown(self):
+        while True:
+            # close() stopped new submissions, let the queued ones finish
+            self.flush()
+            if not self.running:
+                break
+            await asyncio.wait(self.running)
+        if self.client:
+            await self.client.close()
+
+
+async def run(future: Future, coroutine: Awaitable):
+    try:
+        result = await coroutine
+    except BaseException as e:
+        future.set_exception(e)
+        if not isinstance(e, Exception):
+            raise
+    else:
+        future.set_result(result)
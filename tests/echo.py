@@ -0,0 +1,57 @@
+"""Stand-in pools for API level tests, answering by the device token"""
+import asyncio
+import os
+from dataclasses import dataclass
+
+from aapns.api import APNS, Target
+from aapns.connection import Request, Response
+from aapns.errors import Timeout
+
+
+@dataclass
+class EchoPool:
+    """Responds OK to even hex tokens and BadDeviceToken to odd ones, like "bad"
+
+    The token "slow" times out instead. The `apns_id` of OK responses is
+    formatted with the `token` and the `pid` of the process.
+    """
+
+    apns_id: str = "id-{token}"
+    delay: float = 0
+    running: int = 0
+    max_running: int = 0
+    closed: bool = False
+
+    async def post(self, request: Request) -> Response:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            token = dict(request.header)[":path"].rsplit("/", 1)[1]
+            if token == "slow":
+                raise Timeout()
+            if int(token, 16) % 2:
+                return Response.new({":status": "400"}, b'{"reason":"BadDeviceToken"}')
+            apns_id = self.apns_id.format(token=token, pid=os.getpid())
+            return Response.new({":status": "200", "apns-id": apns_id}, b"")
+        finally:
+            self.running -= 1
+
+    async def close(self):
+        self.closed = True
+
+
+class SubmitPool(EchoPool):
+    def submit(self, request: Request, callback):
+        task = asyncio.create_task(self.post(request))
+        task.add_done_callback(
+            lambda task: callback(request, task.exception() or task.result())
+        )
+
+
+class EchoTarget(Target):
+    def __init__(self, pool: EchoPool):
+        self.pool = pool
+
+    async def create_client(self):
+        return APNS(self.pool)
@@ -1,10 +1,18 @@
+import asyncio
+import time
 from dataclasses import dataclass
 from typing import Type
 
 import pytest
-from aapns.api import APNS
+from aapns.api import APNS, PreparedNotification, Result, device_path
+from aapns.coalesce import Coalescer
+from aapns.config import Priority
 from aapns.connection import Request, Response
+from aapns.errors import BadDeviceToken, Suppressed, Timeout
 from aapns.models import Alert, Notification, PushType
+from aapns.suppression import MemorySuppression
+
+from .echo import EchoPool, SubmitPool
 
 pytestmark = [pytest.mark.asyncio]
 
@@ -65,3 +73,211 @@ async def test_request_too_large(push_type, inner_body_size, allowed):
         context = pytest.raises(ValueError)
     with context:
         await api.send_notification("token", notification)
+
+
+async def test_send_many():
+    pool = EchoPool()
+    api = APNS(pool)
+    notification = Notification(alert=Alert(body="hello"))
+
+    results = {}
+    async for token, outcome in api.send_many(
+        (str(i) for i in range(100)), notification, concurrency=7
+    ):
+        results[token] = outcome
+
+    assert len(results) == 100
+    assert results["42"] == "id-42"
+    assert isinstance(results["43"], BadDeviceToken)
+    assert pool.max_running == 7
+
+
+async def test_send_many_async_tokens():
+    async def tokens():
+        for i in range(10):
+            yield str(i * 2)
+
+    api = APNS(EchoPool())
+    notification = Notification(alert=Alert(body="hello"))
+    results = [r async for r in api.send_many(tokens(), notification)]
+    assert sorted(apns_id for token, apns_id in results) == sorted(
+        f"id-{i * 2}" for i in range(10)
+    )
+
+
+async def test_send_many_raises_other_errors():
+    api = APNS(EchoPool())
+    notification = Notification(alert=Alert(body="a" * 5000))
+    with pytest.raises(ValueError):
+        async for token, outcome in api.send_many(["0", "2"], notification):
+            pass
+
+
+def test_prepared_notification():
+    notification = Notification(alert=Alert(body="hello"))
+    prepared = PreparedNotification.new(
+        notification, priority=Priority.immediately, topic="com.example"
+    )
+    request = prepared.request("42", apns_id="some-id")
+    expected = Request.new(
+        "/3/device/42",
+        {
+            "apns-priority": "10",
+            "apns-push-type": "alert",
+            "apns-topic": "com.example",
+            "apns-id": "some-id",
+        },
+        notification.get_dict(),
+    )
+    assert request.header == expected.header
+    assert request.body == expected.body
+    assert prepared.request("43").header[2] == (":path", "/3/device/43")
+
+
+async def test_post_notification():
+    api = APNS(EchoPool())
+    notification = Notification(alert=Alert(body="hello"))
+
+    result = await api.post_notification("42", notification)
+    assert result == Result(200, None, "id-42", None)
+    assert result.ok
+
+    result = await api.post_notification("43", notification)
+    assert result == Result(400, "BadDeviceToken", None, None)
+    assert not result.ok
+    assert isinstance(result.error(), BadDeviceToken)
+
+
+async def test_post_many():
+    api = APNS(EchoPool())
+    notification = Notification(alert=Alert(body="hello"))
+    statuses = [
+        result.status
+        async for token, result in api.post_many(map(str, range(10)), notification)
+    ]
+    assert sorted(statuses) == [200] * 5 + [400] * 5
+
+
+async def test_suppression():
+    api = APNS(EchoPool(), suppression=MemorySuppression())
+    notification = Notification(alert=Alert(body="hello"))
+
+    assert (await api.post_notification("43", notification)).status == 400
+    assert (await api.post_notification("43", notification)).reason == "Suppressed"
+    with pytest.raises(Suppressed):
+        await api.send_notification("43", notification)
+    assert await api.send_notification("42", notification) == "id-42"
+
+
+@pytest.mark.parametrize(
+    "token,path",
+    [
+        ("ab" * 32, "/3/device/" + "ab" * 32),
+        (" AB" * 1 + "ab" * 31 + "\n", "/3/device/" + "ab" * 32),
+        ("ab" * 31, None),
+        ("ab" * 50, "/3/device/" + "ab" * 50),
+        ("ab" * 100, "/3/device/" + "ab" * 100),
+        ("ab" * 101, None),
+        ("ab" * 32 + "a", None),
+        ("xy" * 32, None),
+        ("ab" * 16 + " " + "ab" * 16, None),
+    ],
+)
+def test_device_path(token, path):
+    assert device_path(token) == path
+
+
+async def test_suppression_normalised():
+    suppression = MemorySuppression()
+    api = APNS(EchoPool(), suppression=suppression, validate_tokens=True)
+    notification = Notification(alert=Alert(body="hello"))
+    token = "4" * 62 + "3f"
+
+    assert (await api.post_notification(f" {token.upper()}\n", notification)).status
+    assert list(suppression.entries) == [bytes.fromhex(token)]
+    result = await api.post_notification(token.upper(), notification)
+    assert result.reason == "Suppressed"
+
+
+async def test_validate_tokens():
+    class Sentinel(Exception):
+        pass
+
+    api = APNS(NullPool(Sentinel), validate_tokens=True)
+    notification = Notification(alert=Alert(body="hello"))
+    assert (await api.post_notification("42", notification)).reason == (
+        "BadDeviceToken"
+    )
+    with pytest.raises(BadDeviceToken):
+        await api.send_notification("42", notification)
+    with pytest.raises(Sentinel):
+        await api.send_notification("AB" * 32, notification)
+
+
+async def test_coalesce_collapse_id():
+    pool = EchoPool()
+    api = APNS(pool, coalescer=Coalescer())
+    notification = Notification(alert=Alert(body="hello"))
+    ids = await asyncio.gather(
+        api.send_notification("42", notification, collapse_id="c"),
+        api.send_notification("42", notification, collapse_id="c"),
+        api.send_notification("42", notification),
+    )
+    assert ids == ["id-42"] * 3
+    assert pool.max_running == 2
+
+
+async def test_expired():
+    class Sentinel(Exception):
+        pass
+
+    api = APNS(NullPool(Sentinel))
+    notification = Notification(alert=Alert(body="hello"))
+    with pytest.raises(Sentinel):
+        await api.send_notification(
+            "42", notification, expiration=int(time.time() + 60)
+        )
+    request = PreparedNotification.new(notification, expiration=1).request("42")
+    assert request.deadline_source == "expiration"
+    with pytest.raises(Timeout):
+        request.get_time_left_or_fail()
+
+
+async def test_submit():
+    api = APNS(SubmitPool(), suppression=MemorySuppression(), validate_tokens=True)
+    prepared = PreparedNotification.new(Notification(alert=Alert(body="hello")))
+    outcomes = {}
+    done = asyncio.Event()
+
+    def callback(token, outcome):
+        outcomes[token] = outcome
+        if len(outcomes) == 3:
+            done.set()
+
+    for token in ("42", "1" * 64, "2" * 64):
+        api.submit(token, prepared, callback)
+    await asyncio.wait_for(done.wait(), 1)
+    assert outcomes["42"].reason == "BadDeviceToken"
+    assert outcomes["1" * 64].status == 400
+    assert outcomes["2" * 64].apns_id == "id-" + "2" * 64
+    api.submit("1" * 64, prepared, callback)
+    assert outcomes["1" * 64].reason == "Suppressed"
+    api.submit(" 1" + "1" * 63, prepared, callback)
+    assert outcomes[" 1" + "1" * 63].reason == "Suppressed"
+
+    with pytest.raises(TypeError):
+        APNS(NullPool(Exception)).submit("42", prepared, callback)
+
+
+async def test_fit_payloads():
+    notification = Notification(alert=Alert(body="é" * 3000))
+    with pytest.raises(ValueError):
+        PreparedNotification.new(notification)
+    prepared = PreparedNotification.new(notification, fit=True)
+    assert len(prepared.body) == 4096
+    assert prepared.body.endswith("é…".encode() + b'"}}}')
+
+    api = APNS(EchoPool(), fit_payloads=True)
+    assert await api.send_notification("2", notification) == "id-2"
+    voip = Notification(alert=Alert(body="a" * 6000), push_type=PushType.voip)
+    assert await api.send_notification("4", voip) == "id-4"
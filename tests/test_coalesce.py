@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+from aapns.coalesce import Coalescer
+from aapns.connection import Request, Response
+from aapns.pool import Pool
+
+from .test_pool import FakeConnection
+
+pytestmark = pytest.mark.asyncio
+
+
+class Server:
+    def __init__(self):
+        self.bodies = []
+        self.release = asyncio.Event()
+
+    async def post(self, request: Request) -> Response:
+        await asyncio.sleep(0)
+        self.bodies.append(request.body)
+        await self.release.wait()
+        return Response.new({":status": "200", "apns-id": "x"}, b"")
+
+
+async def test_coalesce():
+    server = Server()
+    coalescer = Coalescer()
+    tasks = [
+        asyncio.create_task(
+            coalescer.post("key", Request.new("/", {}, {}), server.post)
+        )
+        for i in range(3)
+    ]
+    await asyncio.sleep(0.01)
+    server.release.set()
+    responses = await asyncio.gather(*tasks)
+    assert len(server.bodies) == 1
+    assert all(r is responses[0] for r in responses)
+    assert coalescer.coalesced == 2
+    assert not coalescer.pending
+
+
+async def test_different_keys():
+    server = Server()
+    server.release.set()
+    coalescer = Coalescer()
+    await asyncio.gather(
+        *(coalescer.post(k, Request.new("/", {}, {}), server.post) for k in "ab")
+    )
+    assert len(server.bodies) == 2
+
+
+async def test_replace_unsent():
+    server = Server()
+    server.release.set()
+    coalescer = Coalescer(replace=True)
+    first = asyncio.create_task(
+        coalescer.post("key", Request.new("/", {}, {"v": 1}), server.post)
+    )
+    await asyncio.sleep(0)  # the first request is pending, but not sent
+    second = coalescer.post("key", Request.new("/", {}, {"v": 2}), server.post)
+    await asyncio.gather(first, second)
+    assert server.bodies == [b'{"v":2}']
+
+
+async def test_cancel_one_caller():
+    server = Server()
+    coalescer = Coalescer()
+    first = asyncio.create_task(
+        coalescer.post("key", Request.new("/", {}, {}), server.post)
+    )
+    second = asyncio.create_task(
+        coalescer.post("key", Request.new("/", {}, {}), server.post)
+    )
+    await asyncio.sleep(0.01)
+    first.cancel()
+    server.release.set()
+    assert (await second).code == 200
+
+
+async def test_replace_by_deadline():
+    connection = FakeConnection()
+    pool = Pool("https://localhost:1234", 1, None, {connection}, by_deadline=True)
+    coalescer = Coalescer(replace=True)
+    now = time.time()
+    try:
+        first = asyncio.create_task(
+            pool.post(Request.new("/", {}, {}, deadline=now + 9))
+        )
+        await asyncio.sleep(0)
+        queued = Request.new("/", {}, {"v": 1}, deadline=now + 5)
+        tasks = [
+            asyncio.create_task(coalescer.post("key", queued, pool.post)),
+            asyncio.create_task(pool.post(Request.new("/", {}, {}, deadline=now + 3))),
+        ]
+        await asyncio.sleep(0.002)
+        newer = Request.new("/", {}, {"v": 2}, deadline=now + 1)
+        tasks.append(asyncio.create_task(coalescer.post("key", newer, pool.post)))
+        await asyncio.sleep(0)
+        for i in range(3):
+            connection.release.set()
+            await asyncio.sleep(0.002)
+        await asyncio.gather(first, *tasks)
+        # the queued request kept the deadline it's ordered by in the pool
+        assert connection.served == [now + 9, now + 3, now + 5]
+        assert queued.body == b'{"v":2}'
+    finally:
+        await pool.close()
@@ -0,0 +1,83 @@
+import json
+import re
+
+import pytest
+from aapns import codec
+from aapns.connection import Request, Response
+from aapns.models import Alert, Localized, Notification
+
+PAYLOADS = [
+    {},
+    {"aps": {"alert": {"body": "hello", "title": "hi"}, "badge": 3}},
+    {"aps": {"alert": {"loc-key": "k", "loc-args": ["a", "b"]}}, "z": 1, "a": 2},
+    {"text": '\x00\x01\x1f\x7f "quoted" \\ / é ü 漢字 \U0001f600  \n\t\b\f\r'},
+    {"numbers": [0, -1, 2 ** 63 - 1, -(2 ** 63), 2 ** 64, 0.5, -0.0, 123.456]},
+    {"exponents": [1e-7, 1.5e16, -2.5e-300, 1e100, 1e16, 5e-324]},
+    {"nested": {"b": [{"d": None, "c": True}, False], "a": {"y": [], "x": {}}}},
+]
+
+
+def stdlib(data, sort_keys):
+    return json.dumps(
+        data, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys
+    ).encode("utf-8")
+
+
+def exponents_spelled_out(data: bytes) -> bytes:
+    """Exponents the way stdlib writes them, `1e-07` and `1.5e+16`"""
+    return re.sub(
+        rb"(\d)e([+-]?)(\d+)",
+        lambda m: b"%se%s%02d" % (m[1], m[2] or b"+", int(m[3])),
+        data,
+    )
+
+
+@pytest.fixture(params=sorted(codec.CODECS))
+def backend(request):
+    return codec.CODECS[request.param]
+
+
+@pytest.mark.parametrize("sort_keys", [False, True])
+@pytest.mark.parametrize("data", PAYLOADS)
+def test_same_bytes(backend, data, sort_keys):
+    """Identical to stdlib, but for how float exponents are written"""
+    encoded = backend.dumps(data, sort_keys)
+    if backend is codec.STDLIB:
+        assert encoded == stdlib(data, sort_keys)
+    else:
+        assert exponents_spelled_out(encoded) == stdlib(data, sort_keys)
+    assert json.loads(encoded) == data
+    assert backend.loads(stdlib(data, sort_keys)) == data
+
+
+def test_notification(backend):
+    notification = Notification(
+        alert=Alert(body=Localized("k", ["é"]), title="t"),
+        extra={"data": {"z": [1.5, None], "a": "\U0001f600"}, "n": 2 ** 70},
+    )
+    for sort_keys in (False, True):
+        assert notification.encode(sort_keys, backend) == stdlib(
+            notification.get_dict(), sort_keys
+        )
+
+
+def test_non_finite_floats(backend):
+    data = {"x": [float("nan"), float("inf"), float("-inf")]}
+    if backend is codec.STDLIB:
+        assert backend.dumps(data) == b'{"x":[NaN,Infinity,-Infinity]}'
+    else:
+        assert backend.dumps(data) == b'{"x":[null,null,null]}'
+
+
+def test_request_response(backend):
+    request = Request.new("/3/device/42", {}, PAYLOADS[3], codec=backend)
+    assert request.body == stdlib(PAYLOADS[3], False)
+    response = Response.new({":status": "400"}, b'{"reason":"BadDeviceToken"}', backend)
+    assert response.reason == "BadDeviceToken"
+
+
+def test_get():
+    assert codec.get() is codec.STDLIB
+    assert codec.get("json") is codec.STDLIB
+    with pytest.raises(ValueError):
+        codec.get("no-such-backend")
@@ -1,8 +1,25 @@
+import os
 import ssl
+import tracemalloc
+from pathlib import Path
 
+import h2.events
 import pytest
 
-from aapns.connection import Connection
+from aapns.api import PreparedNotification
+from aapns.codec import STDLIB
+from aapns.connection import (
+    MAX_RESPONSE_SIZE,
+    Channel,
+    Connection,
+    Response,
+    cached_ssl_context,
+)
+from aapns.errors import FormatError
+from aapns.models import Alert, Notification
+
+# Bytes allocated per submitted request awaiting its response, about 470 now
+PENDING_REQUEST_BUDGET = 600
 
 pytestmark = pytest.mark.asyncio
 
@@ -30,3 +47,68 @@ async def test_bad_context():
     context.options = 0
     with pytest.raises(ValueError):
         await Connection.create("https://localhost:1234", context)
+
+
+async def test_cached_ssl_context(tmp_path):
+    source = Path(__file__).parent / "functional" / "test-client-certificate.pem"
+    certfile = tmp_path / "client.pem"
+    certfile.write_bytes(source.read_bytes())
+    context = cached_ssl_context(str(certfile))
+    assert cached_ssl_context(str(certfile)) is context
+    assert cached_ssl_context(str(certfile), str(certfile)) is not context
+
+    os.utime(certfile, ns=(0, 0))
+    assert cached_ssl_context(str(certfile)) is not context
+
+
+def test_response_parse():
+    header = [(":status", "200"), ("apns-id", "a"), ("apns-unique-id", "u")]
+    response = Response.parse(header, b"")
+    assert (response.code, response.apns_id, response.apns_unique_id) == (200, "a", "u")
+    assert response.data is None
+    assert response.header == {"apns-id": "a", "apns-unique-id": "u"}
+
+    response = Response.parse([(":status", "410")], b'{"reason":"Unregistered"}')
+    assert (response.code, response.reason, response.apns_id) == (
+        410,
+        "Unregistered",
+        None,
+    )
+    with pytest.raises(FormatError):
+        Response.parse([(":status", "500")], b"<html>")
+
+
+def event(cls, **fields):
+    """h2 event, whatever the h2 version's constructor signature"""
+    instance = cls.__new__(cls)
+    for name, value in fields.items():
+        setattr(instance, name, value)
+    return instance
+
+
+def test_channel_receive():
+    channel = Channel()
+    assert channel.receive(
+        event(h2.events.ResponseReceived, headers=[(":status", "400")])
+    )
+    for chunk in (b'{"reason":', b'"BadTopic"}'):
+        assert channel.receive(event(h2.events.DataReceived, data=chunk))
+    assert channel.response(STDLIB).reason == "BadTopic"
+
+    assert not channel.receive(
+        event(h2.events.DataReceived, data=bytes(MAX_RESPONSE_SIZE))
+    )
+
+
+def test_memory_per_pending_request():
+    prepared = PreparedNotification.new(Notification(alert=Alert(body="hi")))
+    tokens = [f"{i:064x}" for i in range(10_000)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        pending = [Channel(callback=print, request=prepared.request(t)) for t in tokens]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    assert used / len(pending) < PENDING_REQUEST_BUDGET
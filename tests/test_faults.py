@@ -0,0 +1,44 @@
+import pytest
+from aapns.faults import SCENARIOS, run
+
+pytestmark = pytest.mark.asyncio
+
+FILES = (
+    "tests/functional/test-server-certificate.pem",
+    "tests/functional/test-server-private-key.pem",
+    "tests/functional/test-client-certificate.pem",
+)
+
+
+@pytest.mark.parametrize("name", SCENARIOS)
+async def test_scenario(name):
+    report = await run(
+        SCENARIOS[name], *FILES, rate=200, before=0.3, duration=0.4, after=1.5
+    )
+    assert report.scenario == name
+    assert len(report.completions) == report.sent > 300
+    assert report.recovery is not None
+    assert report.amplification >= 1.0 or name == "goaway-storm"
+    if name == "reset-streams":
+        assert set(report.errors) == {"StreamReset"}
+    elif name == "too-many-requests":
+        assert set(report.errors) == {"TooManyRequests"}
+    else:
+        assert report.delivered == report.sent, report.errors
+    if name == "handshake-failures":
+        assert report.peak_retrying > 0
+
+
+async def test_apns_client():
+    report = await run(
+        SCENARIOS["too-many-requests"],
+        *FILES,
+        client="apns",
+        rate=200,
+        before=0.3,
+        duration=0.3,
+        after=0.5,
+    )
+    assert 0 < report.errors["TooManyRequests"] < report.sent
+    assert report.delivered + report.errors["TooManyRequests"] == report.sent
+    assert report.summary()["client"] == "apns"
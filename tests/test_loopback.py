@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from aapns.connection import Connection, Request
+from aapns.errors import Closed
+from aapns.loopback import Recording, pipe, replay
+from aapns.pool import Pool
+from aapns.stub import StubServer
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_pipe():
+    (a_reader, a_writer), (b_reader, b_writer) = pipe()
+    a_writer.write(b"ping")
+    await a_writer.drain()
+    assert await b_reader.readexactly(4) == b"ping"
+    b_writer.write(b"pong")
+    assert await a_reader.readexactly(4) == b"pong"
+
+    a_writer.close()
+    await a_writer.wait_closed()
+    assert await b_reader.read() == b""
+
+
+async def test_connection_over_pipe():
+    async with StubServer(reasons={"BadTopic": 0.5}, seed=1) as stub:
+        connection = Connection.over(*stub.pipe())
+        try:
+            responses = await asyncio.gather(
+                *(
+                    connection.post(Request.new("/3/device/42", {}, {}))
+                    for i in range(20)
+                )
+            )
+        finally:
+            await connection.close()
+    assert {r.reason for r in responses} == {None, "BadTopic"}
+    assert stub.requests == 20
+    with pytest.raises(Closed):
+        await connection.post(Request.new("/3/device/42", {}, {}))
+
+
+async def test_record_replay(tmp_path):
+    recording = Recording()
+    async with StubServer(reasons={"Unregistered": 0.3}, seed=2) as stub:
+        connection = Connection.over(*stub.pipe(), recording=recording)
+        try:
+            responses = await asyncio.gather(
+                *(
+                    connection.post(
+                        Request.new(f"/3/device/{i}", {"apns-topic": "t"}, {"i": i})
+                    )
+                    for i in range(50)
+                )
+            )
+        finally:
+            await connection.close()
+    path = tmp_path / "session.h2"
+    recording.save(path)
+    loaded = Recording.load(path)
+    assert loaded == recording
+
+    requests = loaded.requests()
+    assert [dict(r.header)[":path"] for r in requests] == [
+        f"/3/device/{i}" for i in range(50)
+    ]
+    assert dict(requests[7].header)["apns-topic"] == "t"
+    assert requests[7].body == b'{"i":7}'
+
+    outcomes = await replay(loaded)
+    replayed = {dict(r.header)[":path"]: o for r, o in outcomes}
+    assert len(replayed) == 50
+    for i, response in enumerate(responses):
+        assert replayed[f"/3/device/{i}"].reason == response.reason
+        assert replayed[f"/3/device/{i}"].apns_id == response.apns_id
+
+
+async def test_header_bytes():
+    header = {"apns-topic": "com.example", "apns-push-type": "alert"}
+    async with StubServer() as stub:
+        connection = Connection.over(*stub.pipe())
+        try:
+            await connection.post(Request.new("/3/device/42", header, {}))
+            cold = connection.header_bytes
+            await connection.post(Request.new("/3/device/43", header, {}))
+            warm = connection.header_bytes - cold
+        finally:
+            await connection.close()
+    # the repeated header fields are indexed by HPACK after the first request
+    assert 0 < warm < cold / 2
+
+
+async def header_bytes_per_request(affinity: bool) -> float:
+    header = {"apns-topic": "com.example", "apns-push-type": "alert"}
+    async with StubServer() as stub:
+        connections = [Connection.over(*stub.pipe()) for i in range(4)]
+        pool = Pool("https://localhost", 4, None, set(connections), affinity=affinity)
+        try:
+            for i in range(40):
+                await pool.post(Request.new(f"/3/device/{i:x}", header, {}))
+            per_request = pool.header_bytes_per_request
+            # still counted once the connections are gone
+            for connection in connections:
+                pool.active.discard(connection)
+                pool.retire(connection)
+            assert pool.header_bytes_per_request == per_request
+        finally:
+            await pool.close()
+    # with affinity, only one connection pays for the first, uncompressed headers
+    used = sum(bool(c.streams) for c in connections)
+    assert used == 1 if affinity else used > 1
+    return per_request
+
+
+async def test_header_bytes_per_request():
+    assert await header_bytes_per_request(True) < await header_bytes_per_request(False)
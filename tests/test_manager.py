@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+from aapns import manager
+from aapns.api import Server
+from aapns.connection import Request, Response
+from aapns.manager import PoolManager
+from aapns.models import Alert, Notification
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakePool:
+    """Records requests and responds once released"""
+
+    created: list = []
+    served: list = []
+    gate: asyncio.Event
+    open = max_open = 0
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.closing = False
+
+    @classmethod
+    async def create(cls, origin, size, ssl):
+        await asyncio.sleep(0)
+        pool = cls(origin)
+        cls.created.append(pool)
+        cls.open += 1
+        cls.max_open = max(cls.max_open, cls.open)
+        return pool
+
+    async def post(self, request: Request) -> Response:
+        FakePool.served.append(self.origin)
+        await FakePool.gate.wait()
+        return Response.new({":status": "200", "apns-id": self.origin}, b"")
+
+    async def close(self):
+        if not self.closing:
+            self.closing = True
+            await asyncio.sleep(0.001)
+            FakePool.open -= 1
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(manager, "Pool", FakePool)
+    monkeypatch.setattr(Server, "create_ssl_context", lambda self: None)
+    FakePool.created, FakePool.served = [], []
+    FakePool.open = FakePool.max_open = 0
+    FakePool.gate = asyncio.Event()
+    FakePool.gate.set()
+    yield FakePool
+
+
+def server(name: str) -> Server:
+    return Server(f"{name}.pem", f"{name}.example")
+
+
+async def test_pools_on_demand(fake_pool):
+    pools = PoolManager(max_connections=4)
+    request = Request.new("/3/device/42", {}, {})
+    try:
+        for name in "aab":
+            assert (await pools.post(server(name), request)).apns_id.startswith(
+                f"https://{name}."
+            )
+        assert len(fake_pool.created) == 2
+        assert pools.connections == 4
+
+        # c evicts a, the least recently used
+        await pools.post(server("c"), request)
+        assert list(pools.tenants) == [server("b"), server("c")]
+        assert fake_pool.created[0].closing
+        assert pools.connections == 4
+    finally:
+        await pools.close()
+    assert all(pool.closing for pool in fake_pool.created)
+
+
+async def test_connection_cap_waits(fake_pool):
+    pools = PoolManager(max_connections=2)
+    fake_pool.gate.clear()
+    try:
+        busy = asyncio.create_task(
+            pools.post(server("a"), Request.new("/3/device/1", {}, {}))
+        )
+        await asyncio.sleep(0)
+        other = asyncio.create_task(
+            pools.post(server("b"), Request.new("/3/device/2", {}, {}))
+        )
+        await asyncio.sleep(0.01)
+        assert fake_pool.served == ["https://a.example:443"]
+        fake_pool.gate.set()
+        await asyncio.gather(busy, other)
+        assert len(fake_pool.created) == 2
+        assert fake_pool.created[0].closing
+    finally:
+        await pools.close()
+
+
+async def test_connection_cap_concurrent(fake_pool):
+    pools = PoolManager(max_connections=4)
+    request = Request.new("/3/device/1", {}, {})
+    try:
+        for name in "ab":
+            await pools.post(server(name), request)
+        await asyncio.gather(*(pools.post(server(name), request) for name in "cdef"))
+        assert len(fake_pool.created) == 6
+        assert fake_pool.max_open == 2
+        assert pools.connections <= 4
+    finally:
+        await pools.close()
+
+
+async def test_fair_across_tenants(fake_pool):
+    pools = PoolManager(max_inflight=1)
+    fake_pool.gate.clear()
+    request = Request.new("/3/device/1", {}, {})
+    try:
+        tasks = [
+            asyncio.create_task(pools.post(server(name), request))
+            for name in "a" * 5 + "b" * 2
+        ]
+        for i in range(20):
+            await asyncio.sleep(0)
+            fake_pool.gate.set()
+            fake_pool.gate.clear()
+        fake_pool.gate.set()
+        await asyncio.gather(*tasks)
+        order = "".join(origin[8] for origin in fake_pool.served)
+        assert order == "aababaa"
+    finally:
+        await pools.close()
+
+
+async def test_idle_pools_closed(fake_pool):
+    pools = PoolManager(idle_timeout=0.02)
+    try:
+        client = pools.client(server("a"))
+        await client.post_notification("42", Notification(alert=Alert(body="hi")))
+        await asyncio.sleep(0.05)
+        assert not pools.tenants
+        assert fake_pool.created[0].closing
+    finally:
+        await pools.close()
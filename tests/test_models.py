@@ -1,3 +1,7 @@
+import json
+import timeit
+
+import attr
 import pytest
 from aapns import models
 
@@ -75,3 +79,158 @@ def test_invalid_loc_args():
 def test_invalid_alert_title():
     with pytest.raises(TypeError):
         models.Alert(title=None)
+
+
+def reference(notification, sort_keys):
+    return json.dumps(
+        notification.get_dict(),
+        ensure_ascii=False,
+        separators=(",", ":"),
+        sort_keys=sort_keys,
+    ).encode("utf-8")
+
+
+TEXTS = ["", "plain", 'quote" 100% \\ é\U0001f600\n', models.Localized("key")]
+
+
+@pytest.mark.parametrize("sort_keys", [True, False])
+@pytest.mark.parametrize(
+    "notification",
+    [
+        *(
+            models.Notification(alert=models.Alert(body=body, title=title))
+            for body in TEXTS
+            for title in [None, *TEXTS, models.Localized("t", ["a", "%s"])]
+        ),
+        models.Notification(
+            alert=models.Alert(
+                body="b",
+                subtitle=models.Localized("s", ["x"]),
+                action_loc_key="a",
+                launch_image="i",
+            ),
+            push_type=models.PushType.background,
+            badge=True,
+            sound="s",
+            content_available=True,
+            category="c",
+            thread_id="t",
+            mutable_content=True,
+            target_content_id="id",
+            extra={"z": {"b": [1, 2.5, None], "a": "é"}, "a": 1},
+        ),
+        models.Notification(alert=models.Alert(body="b"), badge=7, extra={"aps": 1}),
+        models.Notification(alert=models.Alert(body="b"), badge=0, extra={}),
+    ],
+)
+def test_encode_matches_json(notification, sort_keys):
+    assert notification.encode(sort_keys) == reference(notification, sort_keys)
+
+
+def test_assignment_validates():
+    notification = models.Notification(alert=models.Alert(body="b"), badge=5)
+    with pytest.raises(TypeError):
+        notification.badge = "5"
+    with pytest.raises(TypeError):
+        notification.alert.title = 42
+    with pytest.raises(TypeError):
+        notification.alert = "b"
+    assert notification.encode() == b'{"aps":{"alert":{"body":"b"},"badge":5}}'
+
+
+def test_encode_faster_than_generic():
+    notification = models.Notification(
+        alert=models.Alert(title="Hello", body=models.Localized("msg", ["Bob"])),
+        badge=3,
+        sound="default",
+        thread_id="chat-42",
+        extra={"chat": 42},
+    )
+    compiled = min(timeit.repeat(notification.encode, number=1000, repeat=5))
+    generic = min(
+        timeit.repeat(lambda: reference(notification, True), number=1000, repeat=5)
+    )
+    assert compiled < generic
+
+
+def test_frozen():
+    notification = models.Notification(
+        alert=models.Alert(title=models.Localized("t", ["a"]), body="b"),
+        badge=1,
+        extra={"x": [1]},
+    )
+    frozen = notification.freeze()
+    assert frozen == notification.freeze()
+    assert hash(frozen) == hash(notification.freeze())
+    assert frozen.alert.title == models.FrozenLocalized("t", ("a",))
+    assert not hasattr(frozen, "__dict__")
+    with pytest.raises(attr.exceptions.FrozenInstanceError):
+        frozen.badge = 2
+    assert frozen.get_dict() == notification.get_dict()
+    for sort_keys in (True, False):
+        assert frozen.encode(sort_keys) == notification.encode(sort_keys)
+        assert frozen.encode(sort_keys) is frozen.encode(sort_keys)
+    assert frozen.size == len(notification.encode(sort_keys=False))
+
+
+def test_frozen_per_codec():
+    class Marker:
+        name = "marker"
+
+        def dumps(self, data, sort_keys=False):
+            return b'"marked"'
+
+    frozen = models.Notification(
+        alert=models.Alert(body="b"), extra={"x": [1]}
+    ).freeze()
+    assert frozen.encode() == b'{"aps":{"alert":{"body":"b"}},"x":[1]}'
+    assert (
+        frozen.encode(codec=Marker()) == b'{"aps":{"alert":{"body":"b"}},"x":"marked"}'
+    )
+    assert frozen.encode() == b'{"aps":{"alert":{"body":"b"}},"x":[1]}'
+
+
+def test_frozen_rejects_mutable_parts():
+    with pytest.raises(TypeError):
+        models.FrozenNotification(alert=models.Alert(body="b"))
+    with pytest.raises(TypeError):
+        models.FrozenAlert(body=models.Localized("b"))
+
+
+@pytest.mark.parametrize(
+    "body", ["a" * 100, 'quote " and \\ backslash ' * 5, "\x01\n" * 40, "é漢😀" * 30],
+)
+@pytest.mark.parametrize("frozen", [False, True])
+def test_fit(body, frozen):
+    notification = models.Notification(alert=models.Alert(title="T", body=body))
+    if frozen:
+        notification = notification.freeze()
+    size = len(notification.encode(sort_keys=False))
+    assert models.fit(notification, size) is notification
+    for limit in range(size - 60, size):
+        fitted = models.fit(notification, limit)
+        assert fitted.alert.title == "T"
+        assert fitted.alert.body.endswith(models.ELLIPSIS)
+        prefix = fitted.alert.body[: -len(models.ELLIPSIS)]
+        assert body.startswith(prefix)
+        assert len(fitted.encode(sort_keys=False)) <= limit
+        if body[len(prefix)].isspace():
+            continue  # trailing space is left out
+        # one more character wouldn't fit
+        longer = attr.evolve(
+            fitted.alert, body=body[: len(prefix) + 1] + models.ELLIPSIS
+        )
+        assert len(attr.evolve(fitted, alert=longer).encode(sort_keys=False)) > limit
+
+
+def test_fit_title():
+    notification = models.Notification(
+        alert=models.Alert(title="title " * 10, body="body " * 10)
+    )
+    fitted = models.fit(notification, 60)
+    assert fitted.alert.body == ""
+    assert fitted.alert.title == "title title title…"
+    assert len(fitted.encode(sort_keys=False)) <= 60
+
+    localized = models.Notification(alert=models.Alert(body=models.Localized("k")))
+    assert models.fit(localized, 10) == localized
@@ -1,8 +1,12 @@
+import asyncio
 import ssl
+import time
 
 import pytest
 
-from aapns.pool import Pool
+from aapns.connection import Request, Response
+from aapns.errors import Blocked, Closed, Timeout
+from aapns.pool import Lane, Pool
 
 pytestmark = pytest.mark.asyncio
 
@@ -22,3 +26,205 @@ async def test_bad_context():
     context.options = 0
     with pytest.raises(ValueError):
         await Pool.create("https://localhost:1234", 2, context)
+
+
+class FakeConnection:
+    """Serves one request at a time, until released"""
+
+    closing = closed = False
+    channels: dict = {}
+    max_concurrent_streams = 2
+
+    @property
+    def pending(self):
+        return int(self.busy)
+
+    def __init__(self):
+        self.busy = False
+        self.served = []
+        self.release = asyncio.Event()
+
+    async def post(self, request: Request) -> Response:
+        if self.busy:
+            raise Blocked()
+        self.busy = True
+        request.sent = True
+        try:
+            self.served.append(request.deadline)
+            await self.release.wait()
+            self.release.clear()
+            return Response.new({":status": "200"}, b"")
+        finally:
+            self.busy = False
+
+    def submit(self, request: Request, callback):
+        if self.busy:
+            raise Blocked()
+        self.busy = True
+        self.served.append(request.deadline)
+
+        def done():
+            self.busy = False
+            callback(request, Response.new({":status": "200"}, b""))
+
+        self.done = done
+
+    async def close(self):
+        pass
+
+
+async def test_by_deadline():
+    connection = FakeConnection()
+    pool = Pool("https://localhost:1234", 1, None, {connection}, by_deadline=True)
+    try:
+        now = time.time()
+        first = asyncio.create_task(
+            pool.post(Request.new("/", {}, {}, deadline=now + 9))
+        )
+        await asyncio.sleep(0)
+        later = [
+            asyncio.create_task(pool.post(Request.new("/", {}, {}, deadline=now + d)))
+            for d in (3, 1, 2)
+        ]
+        expired = asyncio.create_task(pool.post(Request.new("/", {}, {}, timeout=0.01)))
+        await asyncio.sleep(0.02)
+        for i in range(4):
+            connection.release.set()
+            await asyncio.sleep(0.001)
+        await asyncio.gather(first, *later)
+        with pytest.raises(Timeout):
+            await expired
+        assert connection.served == [now + 9, now + 1, now + 2, now + 3]
+    finally:
+        await pool.close()
+
+
+async def test_lanes():
+    shared, reserved = FakeConnection(), FakeConnection()
+    lane = Lane("urgent", 1, {"apns-priority": "10"})
+    pool = Pool("https://localhost:1234", 2, None, {shared, reserved}, lanes=[lane])
+    normal = Request.new("/", {"apns-priority": "5"}, {})
+    urgent = Request.new("/", {"apns-priority": "10"}, {})
+    try:
+        if pool.lane_of != {reserved: "urgent"}:
+            shared, reserved = reserved, shared
+        assert pool.lane_of == {reserved: "urgent"}
+
+        # urgent requests go to the reserved connection first
+        task = asyncio.create_task(pool.post(urgent))
+        await asyncio.sleep(0)
+        assert reserved.served and not shared.served
+        reserved.release.set()
+        await task
+
+        # normal requests borrow the reserved connection when the lane is idle
+        tasks = [asyncio.create_task(pool.post(normal)) for i in "12"]
+        await asyncio.sleep(0)
+        assert len(shared.served) == 1
+        assert len(reserved.served) == 2
+        shared.release.set()
+        reserved.release.set()
+        await asyncio.gather(*tasks)
+    finally:
+        await pool.close()
+
+
+async def test_lanes_too_large():
+    with pytest.raises(ValueError):
+        await Pool.create("https://localhost:1234", 2, lanes=[Lane("x", 2, {})])
+
+
+async def test_affinity():
+    connections = [FakeConnection() for i in range(3)]
+    pool = Pool("https://localhost:1234", 3, None, set(connections), affinity=True)
+    request = Request.new("/", {"apns-topic": "a", "apns-push-type": "alert"}, {})
+    try:
+        for i in range(3):
+            task = asyncio.create_task(pool.post(request))
+            await asyncio.sleep(0)
+            for c in connections:
+                c.release.set()
+            await task
+        preferred = [c for c in connections if c.served]
+        assert len(preferred) == 1
+        assert len(preferred[0].served) == 3
+
+        # falls back to another connection while the preferred one is busy
+        tasks = [asyncio.create_task(pool.post(request)) for i in "12"]
+        await asyncio.sleep(0)
+        assert sum(bool(c.served) for c in connections) == 2
+        for c in connections:
+            c.release.set()
+        await asyncio.gather(*tasks)
+    finally:
+        await pool.close()
+
+
+async def test_submit():
+    connection = FakeConnection()
+    pool = Pool("https://localhost:1234", 1, None, {connection})
+    outcomes = []
+    callback = lambda request, outcome: outcomes.append(outcome)
+    try:
+        now = time.time()
+        for d in (3, 1, 2):
+            pool.submit(Request.new("/", {}, {}, deadline=now + d), callback)
+        pool.submit(Request.new("/", {}, {}, timeout=0.01), callback)
+        assert connection.served == [now + 3]
+        assert len(pool.backlog) == 3
+        await asyncio.sleep(0.05)
+        assert len(outcomes) == 1 and isinstance(outcomes[0], Timeout)
+        for i in range(3):
+            connection.done()
+        assert [o.code for o in outcomes[1:]] == [200, 200, 200]
+        assert connection.served == [now + 3, now + 1, now + 2]
+        assert pool.completed == 3 and pool.errors == 1
+
+        pool.submit(Request.new("/", {}, {}), callback)
+        pool.submit(Request.new("/", {}, {}), callback)
+    finally:
+        await pool.close()
+    assert isinstance(outcomes[-1], Closed)
+    with pytest.raises(Closed):
+        pool.submit(Request.new("/", {}, {}), callback)
+
+
+async def test_submit_backlog_full():
+    connection = FakeConnection()
+    pool = Pool("https://localhost:1234", 1, None, {connection}, max_backlog=2)
+    callback = lambda request, outcome: None
+    try:
+        for i in range(3):
+            pool.submit(Request.new("/", {}, {}), callback)
+        with pytest.raises(Blocked):
+            pool.submit(Request.new("/", {}, {}), callback)
+        assert len(pool.backlog) == 2
+    finally:
+        await pool.close()
+
+
+async def test_submit_lanes():
+    shared, reserved = FakeConnection(), FakeConnection()
+    lane = Lane("urgent", 1, {"apns-priority": "10"})
+    pool = Pool("https://localhost:1234", 2, None, {shared, reserved}, lanes=[lane])
+    outcomes = []
+    callback = lambda request, outcome: outcomes.append(outcome)
+    try:
+        if pool.lane_of != {reserved: "urgent"}:
+            shared, reserved = reserved, shared
+
+        pool.submit(Request.new("/", {"apns-priority": "10"}, {}), callback)
+        assert reserved.served and not shared.served
+        assert pool.lane_pending["urgent"] == 1
+
+        # the lane is busy, so normal requests don't borrow its connection
+        pool.submit(Request.new("/", {"apns-priority": "5"}, {}), callback)
+        pool.submit(Request.new("/", {"apns-priority": "5"}, {}), callback)
+        assert len(shared.served) == 1 and len(reserved.served) == 1
+        assert len(pool.backlog) == 1
+
+        reserved.done()
+        assert pool.lane_pending["urgent"] == 0
+        assert len(outcomes) == 1
+    finally:
+        await pool.close()
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import aapns.ratelimit
+import pytest
+from aapns.connection import Request, Response
+from aapns.errors import RateLimited, Timeout
+from aapns.ratelimit import Limit, RateLimitedPool
+
+
+class CountingPool:
+    def __init__(self, reason=None):
+        self.posted = 0
+        self.reason = reason
+
+    async def post(self, request: Request) -> Response:
+        self.posted += 1
+        if self.reason:
+            return Response.new({":status": "429"}, b'{"reason":"%s"}' % self.reason)
+        return Response.new({":status": "200"}, b"")
+
+    async def close(self):
+        pass
+
+
+def request(token="42", topic=None, timeout=10):
+    return Request.new(
+        f"/3/device/{token}", {"apns-topic": topic} if topic else {}, {}, timeout
+    )
+
+
+@pytest.mark.asyncio
+async def test_reject():
+    pool = RateLimitedPool(CountingPool(), total=Limit(1, burst=3), wait=False)
+    for i in range(3):
+        await pool.post(request())
+    with pytest.raises(RateLimited):
+        await pool.post(request())
+    assert pool.pool.posted == 3
+    assert pool.limited == 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake time, that passes only by sleeping"""
+    now = [1000.0]
+
+    async def sleep(delay):
+        now[0] += delay
+
+    monkeypatch.setattr(aapns.ratelimit, "monotonic", lambda: now[0])
+    monkeypatch.setattr(aapns.ratelimit, "sleep", sleep)
+    return now
+
+
+@pytest.mark.asyncio
+async def test_wait(clock):
+    pool = RateLimitedPool(CountingPool(), device=Limit(100, burst=1))
+    started = clock[0]
+    for i in range(3):
+        await pool.post(request())
+    await pool.post(request("43"))
+    assert clock[0] - started == pytest.approx(0.02)
+    assert pool.limited == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_wait_refunds():
+    pool = RateLimitedPool(CountingPool(), total=Limit(10, burst=1))
+    await pool.post(request())
+    waiter = asyncio.create_task(pool.post(request()))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert pool.pool.posted == 1
+    pool.total_bucket.refill(time.monotonic())
+    assert pool.total_bucket.tokens > -0.5
+
+
+@pytest.mark.parametrize("rate,burst", [(0, None), (-1, None), (1, 0)])
+def test_invalid_limit(rate, burst):
+    with pytest.raises(ValueError):
+        Limit(rate, burst)
+
+
+@pytest.mark.asyncio
+async def test_wait_past_deadline():
+    pool = RateLimitedPool(CountingPool(), topic=Limit(1, burst=1))
+    await pool.post(request(topic="a"))
+    await pool.post(request(topic="b"))
+    with pytest.raises(Timeout):
+        await pool.post(request(topic="a", timeout=0.1))
+
+
+@pytest.mark.asyncio
+async def test_tighten():
+    pool = RateLimitedPool(CountingPool(b"TooManyRequests"), device=Limit(10))
+    await pool.post(request())
+    assert pool.tightened == 1
+    assert pool.device_buckets["/3/device/42"].rate == 5
+
+
+@pytest.mark.asyncio
+async def test_device_lru():
+    pool = RateLimitedPool(CountingPool(), device=Limit(10), max_devices=2)
+    for token in "1231":
+        await pool.post(request(token))
+    assert list(pool.device_buckets) == ["/3/device/3", "/3/device/1"]
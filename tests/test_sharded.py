@@ -0,0 +1,39 @@
+import pytest
+from aapns.api import PreparedNotification, Target
+from aapns.errors import Timeout
+from aapns.models import Alert, Notification
+from aapns.sharded import ShardedSender
+
+from .echo import EchoPool, EchoTarget, SubmitPool
+
+
+class BadTarget(Target):
+    async def create_client(self):
+        raise OSError("no route")
+
+
+@pytest.mark.parametrize("pool_class", [EchoPool, SubmitPool])
+def test_post_many(pool_class):
+    prepared = PreparedNotification.new(Notification(alert=Alert(body="hello")))
+    tokens = [str(i * 2) for i in range(1000)] + ["bad", "slow"]
+    with ShardedSender.create(
+        EchoTarget(pool_class(apns_id="{pid}")),
+        3,
+        batch_size=16,
+        window=2,
+        start_method="fork",
+    ) as sender:
+        outcomes = dict(sender.post_many(tokens, prepared))
+        pids = {sender.shard(t): outcomes[t].apns_id for t in tokens[:1000]}
+        assert len(set(pids.values())) == 3
+        for token in tokens[:1000]:
+            assert outcomes[token].apns_id == pids[sender.shard(token)]
+        assert outcomes["bad"].reason == "BadDeviceToken"
+        assert isinstance(outcomes["slow"], Timeout)
+        assert sender.stats == {"Success": 1000, "BadDeviceToken": 1, "Timeout": 1}
+    assert not any(p.is_alive() for p in sender.processes)
+
+
+def test_create_fails():
+    with pytest.raises(OSError):
+        ShardedSender.create(BadTarget(), 2, start_method="fork")
@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+from aapns.connection import Connection, Request, cached_ssl_context
+from aapns.errors import Blocked, Closed, StreamReset
+from aapns.pool import Pool
+from aapns.stub import StubServer
+
+pytestmark = pytest.mark.asyncio
+
+SERVER_CERT = "tests/functional/test-server-certificate.pem"
+SERVER_KEY = "tests/functional/test-server-private-key.pem"
+CLIENT_CERT = "tests/functional/test-client-certificate.pem"
+
+
+def stub(**kwargs) -> StubServer:
+    return StubServer(SERVER_CERT, SERVER_KEY, **kwargs)
+
+
+def ssl_context():
+    return cached_ssl_context(CLIENT_CERT, SERVER_CERT)
+
+
+def request(apns_id=None):
+    return Request.new("/3/device/42", {"apns-id": apns_id} if apns_id else {}, {})
+
+
+async def test_ok():
+    async with stub(max_concurrent_streams=7) as server:
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            response = await connection.post(request("42-42"))
+            assert (response.code, response.apns_id) == (200, "42-42")
+            assert connection.max_concurrent_streams == 7
+        finally:
+            await connection.close()
+    assert server.requests == 1
+    assert server.responses == {None: 1}
+
+
+async def test_reasons_and_latency():
+    reasons = {"Unregistered": 0.5, "TooManyRequests": 0.25}
+    async with stub(latency=lambda rng: rng.random() / 100, reasons=reasons) as server:
+        pool = await Pool.create(server.origin, 1, ssl_context())
+        try:
+            responses = await asyncio.gather(
+                *(pool.post(request()) for i in range(200))
+            )
+        finally:
+            await pool.close()
+    codes = {r.reason: r.code for r in responses}
+    assert codes == {"Unregistered": 410, "TooManyRequests": 429, None: 200}
+    assert all(r.timestamp for r in responses if r.reason == "Unregistered")
+    assert 70 < server.responses["Unregistered"] < 130
+
+
+async def test_seed():
+    def outcomes():
+        server = stub(reasons={"BadDeviceToken": 0.5}, seed=42)
+        return [server.pick_reason() for i in range(20)]
+
+    assert outcomes() == outcomes()
+
+
+async def test_goaway():
+    async with stub(goaway_after=2, goaway_reason="Shutdown") as server:
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            await connection.post(request())
+            await connection.post(request())
+            with pytest.raises(Closed, match="Shutdown"):
+                await connection.post(request())
+        finally:
+            await connection.close()
+
+
+async def test_drop():
+    async with stub(drop_after=2) as server:
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            await connection.post(request())
+            with pytest.raises(Closed):
+                await connection.post(request())
+        finally:
+            await connection.close()
+
+        # a pool retries on a new connection
+        pool = await Pool.create(server.origin, 1, ssl_context())
+        try:
+            responses = [await pool.post(request()) for i in range(3)]
+            assert [r.code for r in responses] == [200] * 3
+        finally:
+            await pool.close()
+    assert server.responses == {None: 4}
+
+
+async def test_window_size():
+    body = {"data": "x" * 3000}
+    async with stub(initial_window_size=4000, connection_window_size=10 ** 6) as server:
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            responses = await asyncio.gather(
+                *(connection.post(Request.new("/3/device/1", {}, body)) for i in "123")
+            )
+            assert connection.protocol.remote_settings.initial_window_size == 4000
+            assert connection.protocol.outbound_flow_control_window > 10 ** 6 - 10 ** 4
+        finally:
+            await connection.close()
+    assert [r.code for r in responses] == [200] * 3
+
+
+async def test_reset_streams():
+    async with stub(reset_streams=0.5, seed=3) as server:
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            outcomes = await asyncio.gather(
+                *(connection.post(request()) for i in range(40)),
+                return_exceptions=True,
+            )
+        finally:
+            await connection.close()
+    resets = sum(isinstance(o, StreamReset) for o in outcomes)
+    assert 5 < resets < 35
+    assert server.responses == {"StreamReset": resets, None: 40 - resets}
+
+
+async def test_handshake_failures():
+    async with stub(handshake_failures=1) as server:
+        with pytest.raises(OSError):
+            await Connection.create(server.origin, ssl_context())
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            assert (await connection.post(request())).code == 200
+        finally:
+            await connection.close()
+    assert server.handshake_failures == 0
+
+
+async def test_window_update_delay():
+    body = {"data": "x" * 15000}
+    async with stub(window_update_delay=0.3) as server:
+        connection = await Connection.create(server.origin, ssl_context())
+        try:
+            # the 65535 byte window fits 4 bodies
+            await asyncio.gather(
+                *(connection.post(Request.new("/3/device/1", {}, body)) for i in "1234")
+            )
+            with pytest.raises(Blocked):
+                await connection.post(Request.new("/3/device/1", {}, body))
+            await asyncio.sleep(0.4)
+            await connection.post(Request.new("/3/device/1", {}, body))
+        finally:
+            await connection.close()
+
+
+async def test_go_away_all():
+    async with stub() as server:
+        connections = [
+            await Connection.create(server.origin, ssl_context()) for i in "12"
+        ]
+        try:
+            await asyncio.sleep(0.1)
+            server.go_away()
+            await asyncio.sleep(0.1)
+            assert all(c.closing for c in connections)
+        finally:
+            for connection in connections:
+                await connection.close()
@@ -0,0 +1,114 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+from aapns import suppression
+from aapns.suppression import MemorySuppression, SQLiteSuppression, token_key
+
+TOKEN = "ab" * 32
+
+
+def test_token_key():
+    assert token_key(TOKEN) == b"\xab" * 32
+    assert token_key("not-hex") == b"not-hex"
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield MemorySuppression(ttl=60)
+    else:
+        store = SQLiteSuppression(str(tmp_path / "suppressed.db"), ttl=60)
+        yield store
+        store.close()
+
+
+def test_add_discard(store):
+    assert TOKEN not in store
+    store.add(TOKEN)
+    assert TOKEN in store
+    assert TOKEN.upper() in store
+    assert len(store) == 1
+    store.discard(TOKEN)
+    assert TOKEN not in store
+
+
+def test_expiry(store, monkeypatch):
+    now = time.time()
+    store.add(TOKEN)
+    monkeypatch.setattr(suppression, "time", lambda: now + 59)
+    assert TOKEN in store
+    monkeypatch.setattr(suppression, "time", lambda: now + 61)
+    assert TOKEN not in store
+
+
+def test_reported_long_ago(store):
+    # the TTL counts from when the token was added, not from when it went bad
+    store.add(TOKEN, since=time.time() - 40 * 86400)
+    assert TOKEN in store
+    store.purge()
+    assert TOKEN in store
+
+
+def test_registered_again(store):
+    now = time.time()
+    store.add(TOKEN, since=now)
+    store.discard(TOKEN, registered_at=now - 1)
+    assert TOKEN in store
+    store.discard(TOKEN, registered_at=now + 1)
+    assert TOKEN not in store
+
+
+def test_sqlite_persists(tmp_path):
+    path = str(tmp_path / "suppressed.db")
+    store = SQLiteSuppression(path)
+    store.add(TOKEN)
+    store.close()
+    store = SQLiteSuppression(path)
+    try:
+        assert TOKEN in store
+        assert "cd" * 32 not in store
+    finally:
+        store.close()
+
+
+def rows(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("SELECT count(*) FROM suppressed").fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_sqlite_batches(tmp_path):
+    path = str(tmp_path / "suppressed.db")
+    store = SQLiteSuppression(path, batch_size=3)
+    try:
+        store.add("01" * 32)
+        store.add("02" * 32, since=1)
+        store.add("02" * 32, since=2)
+        assert "02" * 32 in store
+        assert rows(path) == 0
+        store.add("03" * 32)
+        assert rows(path) == 3
+        # an earlier report doesn't move the time back
+        store.add("02" * 32, since=1)
+        store.flush()
+        query = "SELECT since FROM suppressed WHERE token = ?"
+        assert store.db.execute(query, (b"\x02" * 32,)).fetchone() == (2,)
+    finally:
+        store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_flush_interval(tmp_path):
+    path = str(tmp_path / "suppressed.db")
+    store = SQLiteSuppression(path, flush_interval=0.01)
+    try:
+        store.add(TOKEN)
+        assert rows(path) == 0
+        await asyncio.sleep(0.05)
+        assert rows(path) == 1
+    finally:
+        store.close()
@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from aapns.api import Target
+from aapns.errors import BadDeviceToken, Closed
+from aapns.models import Alert, Notification
+from aapns.sync import SyncClient
+
+from .echo import EchoPool, EchoTarget
+
+
+def test_send_from_threads():
+    target = EchoTarget(EchoPool(delay=0.001))
+    notification = Notification(alert=Alert(body="hello"))
+    with SyncClient.create(target) as client:
+        with ThreadPoolExecutor(4) as executor:
+            futures = list(
+                executor.map(
+                    lambda i: client.send_notification(str(i * 2), notification),
+                    range(200),
+                )
+            )
+        assert [f.result() for f in futures] == [f"id-{i * 2}" for i in range(200)]
+        assert client.wakeups < 200
+        assert client.post_notification("bad", notification).result().status == 400
+        with pytest.raises(BadDeviceToken):
+            client.send_notification("bad", notification).result()
+        last = client.send_notification("ee", notification)
+    assert last.result() == "id-ee"
+    assert target.pool.closed
+    assert not client.thread.is_alive()
+    with pytest.raises(Closed):
+        client.send_notification("42", notification)
+
+
+def test_bad_call_in_batch():
+    notification = Notification(alert=Alert(body="hello"))
+    with SyncClient.create(EchoTarget(EchoPool())) as client:
+        # keep the loop busy, so that all three are started in one batch
+        client.loop.call_soon_threadsafe(time.sleep, 0.05)
+        futures = [
+            client.send_notification("2", notification),
+            client.send_notification("4", notification, bogus=True),
+            client.send_notification("6", notification),
+        ]
+        assert client.wakeups == 1
+        with pytest.raises(TypeError):
+            futures[1].result(1)
+        assert futures[0].result(1) == "id-2"
+        assert futures[2].result(1) == "id-6"
+
+
+def test_create_fails():
+    class BadTarget(Target):
+        async def create_client(self):
+            raise OSError("no route")
+
+    before = threading.active_count()
+    with pytest.raises(OSError):
+        SyncClient.create(BadTarget())
+    assert threading.active_count() == before